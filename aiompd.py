@@ -0,0 +1,395 @@
+import asyncio
+import concurrent.futures
+import logging
+from collections import deque
+from threading import Thread, Lock
+from time import sleep
+
+import events
+from mympd import MyMPD, StatusModel, StatusWatcher, Backoff, BatchError, ack_pattern, init_local_paths, \
+    CircuitBreaker, Command, Batch, CommandWorker
+
+__author__ = 'jeroen'
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class CommandError(Exception):
+    """ mpd answered with ACK """
+
+    def __init__(self, ack):
+        Exception.__init__(self, ack)
+        match = ack_pattern.search(ack)
+        self.position = int(match.group(1)) if match else 0  # position in a command list
+
+
+class Response:
+    """ the answer to a single command, parsed line by line as it comes in """
+
+    def __init__(self, delimiter=None, values=False):
+        self.delimiter = delimiter  # if set, every occurrence of this key starts a new object in a list of objects
+        self.values = values  # if set, the result is just a list of values (e.g. 'changed: player' for idle)
+        self.result = [] if delimiter or values else {}
+        self.current = None
+
+    def feed(self, key, value):
+        if self.values:
+            self.result.append(value)
+            return
+        key = key.lower()
+        if self.delimiter:
+            if self.current is None or key == self.delimiter:
+                self.current = {}
+                self.result.append(self.current)
+            obj = self.current
+        else:
+            obj = self.result
+        if key not in obj:
+            obj[key] = value
+        elif isinstance(obj[key], list):
+            obj[key].append(value)
+        else:
+            obj[key] = [obj[key], value]
+
+    def next(self):
+        raise ProtocolError("unexpected list_OK")
+
+    def finish(self):
+        return self.result
+
+
+class NoResponse(Response):
+    """ for commands that don't return anything """
+
+    def finish(self):
+        return None
+
+
+class CommandListResponse:
+    """ the answers to a command list, separated by list_OK """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.index = 0
+
+    def feed(self, key, value):
+        self.responses[self.index].feed(key, value)
+
+    def next(self):
+        self.index += 1
+
+    def finish(self):
+        return [r.finish() for r in self.responses]
+
+
+# how to parse the answer of the commands that return something (all others return None)
+responses = {
+    'status': Response,
+    'currentsong': Response,
+    'listplaylists': (lambda: Response(delimiter='playlist')),
+    'idle': (lambda: Response(values=True)),
+    'noidle': (lambda: Response(values=True)),
+}
+
+
+def create_response(name):
+    return responses.get(name, NoResponse)()
+
+
+def encode(command):
+    """ :param command: tuple (name, arg1, arg2, ...) """
+    parts = [command[0]]
+    for arg in command[1:]:
+        parts.append('"' + str(arg).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return ' '.join(parts) + '\n'
+
+
+class Connection:
+    """
+    A single connection to mpd, speaking the text protocol over asyncio streams. Requests are pipelined: they are
+    written right away, and the answers (which mpd sends in order) are matched with the pending requests by a reader
+    task that parses them line by line.
+    """
+
+    def __init__(self, host, port):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.pending = deque()  # tuples (response, future), in the order the commands were sent
+        self.lock = None
+
+    def is_open(self):
+        return self.writer is not None
+
+    async def open(self):
+        """ open the connection, unless it's already open """
+        if self.lock is None:
+            self.lock = asyncio.Lock()  # created here, to make sure it belongs to the running loop
+        async with self.lock:
+            if self.is_open():
+                return
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            hello = await reader.readline()
+            if not hello.startswith(b'OK MPD '):
+                writer.close()
+                raise ProtocolError("unexpected greeting: " + repr(hello))
+            self.logger.debug("connected to " + hello.decode('utf-8').strip())
+            self.reader, self.writer = reader, writer
+            asyncio.ensure_future(self.read_responses(reader))
+
+    def command(self, name, *args):
+        """ :return: future with the (parsed) answer of mpd """
+        return self.send(encode((name,) + args), create_response(name))
+
+    def command_list(self, commands):
+        """ :return: future with a list holding the answer to every command """
+        lines = 'command_list_ok_begin\n' + ''.join(encode(c) for c in commands) + 'command_list_end\n'
+        return self.send(lines, CommandListResponse([create_response(c[0]) for c in commands]))
+
+    def noidle(self):
+        """ interrupt a pending idle command, which will then return its (possibly empty) list of changes """
+        self.writer.write(b'noidle\n')
+
+    def send(self, lines, response):
+        if not self.is_open():
+            raise ConnectionError("not connected")
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((response, future))
+        self.writer.write(lines.encode('utf-8'))
+        return future
+
+    async def read_responses(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b'\n'):
+                    raise ConnectionError("connection lost")
+                line = line[:-1].decode('utf-8')
+                if not self.pending:
+                    raise ProtocolError("unexpected line: " + line)
+                response, future = self.pending[0]
+                if line == 'OK':
+                    self.pending.popleft()
+                    if not future.done():
+                        future.set_result(response.finish())
+                elif line == 'list_OK':
+                    response.next()
+                elif line.startswith('ACK '):
+                    self.pending.popleft()
+                    if not future.done():
+                        future.set_exception(CommandError(line[4:]))
+                else:
+                    key, _, value = line.partition(': ')
+                    response.feed(key, value)
+        except (OSError, ProtocolError) as e:
+            if self.reader is reader:  # not reconnected in the meantime
+                self.logger.info("connection to " + self.host + " closed: " + str(e))
+                self.close(e)
+
+    def close(self, error=None):
+        if self.writer:
+            self.writer.close()
+        self.reader, self.writer = None, None
+        while self.pending:
+            _, future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(str(error) if error else "connection closed"))
+
+
+class AsyncMPD(MyMPD):
+    """
+    MyMPD that talks to mpd from an asyncio event loop running in a background thread. It has two connections:
+    one spends its time in 'idle' to keep the status snapshot up to date, the other one executes commands, pipelined.
+    None of the methods called from the pygame loop wait for the network, except init_playlists.
+    Like PiMPD, both connections share a CircuitBreaker: while mpd is unreachable, idempotent commands are kept and
+    replayed once the link is back, other commands fail.
+    """
+    host = 'localhost'
+    port = 6600
+    query_timeout = 10  # seconds
+
+    def __init__(self, screen_size, thumb_size=None, workers=None, processes=False):
+        MyMPD.__init__(self, screen_size, thumb_size, workers, processes)
+        init_local_paths()
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.lock = Lock()
+        self.snapshot = {}
+        self.model = StatusModel()
+
+        self.loop = asyncio.new_event_loop()
+        thread = Thread(target=self.loop.run_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+        self.commands = Connection(self.host, self.port)
+        self.idle = Connection(self.host, self.port)
+        self.watching = False
+        self.health = CircuitBreaker()
+        self.health.add_listener(self.health_changed)
+        self.replay = []  # idempotent commands to execute once mpd is back (only touched in the event loop)
+
+    def connect(self):
+        pass  # connections are opened when needed
+
+    def subscribe(self):
+        if not self.watching:
+            self.watching = True
+            asyncio.run_coroutine_threadsafe(self.watch(), self.loop)
+
+    async def watch(self):
+        while True:
+            while not self.health.allow():
+                await asyncio.sleep(self.health.wait_time() or 0.1)  # (None: the commands connection is probing)
+            try:
+                await self.idle.open()
+                self.health.succeeded()
+                await self.refresh()
+                while True:
+                    changed = await self.wait_for_changes()
+                    self.logger.debug("mpd: idle returned " + str(changed))
+                    if StatusWatcher.status_subsystems.intersection(changed) or not changed:
+                        await self.refresh()
+                    if 'stored_playlist' in changed:
+                        playlists = await self.idle.command('listplaylists')
+                        events.post(events.MPD_IDLE, changed=changed, playlists=playlists)
+                    elif changed:
+                        events.post(events.MPD_IDLE, changed=changed)
+            except (OSError, ProtocolError, CommandError) as e:
+                self.logger.info('mpd: idle connection lost (' + str(e) + ')')
+                self.idle.close(e)
+                self.health.failed()
+
+    def health_changed(self):
+        if self.health.is_connected():
+            asyncio.run_coroutine_threadsafe(self.replay_commands(), self.loop)
+
+    async def replay_commands(self):
+        replay, self.replay = self.replay, []
+        for command in replay:
+            self.logger.info('mpd: replaying ' + str(command))
+            await self.run_command(command)
+
+    def is_connected(self):
+        return self.health.is_connected()
+
+    async def wait_for_changes(self):
+        """ :return: list of changed subsystems, empty if it's time to resync the elapsed time """
+        idle = self.idle.command('idle', *StatusWatcher.subsystems)
+        with self.lock:
+            timeout = self.model.time_to_resync()
+        done, _ = await asyncio.wait([idle], timeout=timeout)
+        if not done:
+            self.idle.noidle()
+        return await idle
+
+    async def refresh(self):
+        # both requests are sent before the first answer is read
+        status, song = await asyncio.gather(self.idle.command('status'), self.idle.command('currentsong'))
+        status.update(song)
+        with self.lock:
+            self.snapshot = status
+            self.model.update(status)
+
+    async def execute(self, commands):
+        await self.commands.open()
+        if len(commands) == 1:
+            return await self.commands.command(*commands[0])
+        try:
+            return await self.commands.command_list(commands)
+        except CommandError as e:
+            raise BatchError(e.position, commands[e.position], e)
+
+    def submit(self, commands):
+        """ execute commands in the background, a MPD_COMMAND event is posted when done """
+        command = Command(commands[0][0], tuple(commands[0][1:])) if len(commands) == 1 else Batch(commands)
+        asyncio.run_coroutine_threadsafe(self.run_command(command), self.loop)
+
+    async def run_command(self, command):
+        if not self.health.allow():
+            self.postpone(command, ConnectionError('mpd unreachable'))
+            return
+        try:
+            result = await self.execute(command.calls())
+        except (CommandError, BatchError) as e:
+            self.logger.warning('mpd: ' + str(command) + ' failed: ' + str(e))
+            CommandWorker.report(command, error=e)
+            return
+        except (OSError, ProtocolError) as e:
+            self.logger.info('mpd: ' + e.__class__.__name__ + ' (' + str(e) + ') while executing ' + str(command))
+            self.commands.close(e)
+            self.postpone(command, e)
+            self.health.failed()
+            return
+        if not self.health.is_connected():
+            self.health.succeeded()  # this command was the probe
+        CommandWorker.report(command, result)
+
+    def postpone(self, command, error):
+        """ mpd is unreachable: replay command once it's back if that's safe, fail it otherwise """
+        if command.is_idempotent():
+            self.logger.info('mpd: ' + str(command) + ' will be replayed')
+            self.replay.append(command)
+        else:
+            CommandWorker.report(command, error=error)
+
+    def query(self, *command):
+        """ execute a command and wait for the answer (but not longer than query_timeout) """
+        future = asyncio.run_coroutine_threadsafe(self.execute([command]), self.loop)
+        try:
+            return future.result(self.query_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise ConnectionError("mpd didn't answer " + command[0] + " within " + str(self.query_timeout) + " seconds")
+
+    def init_playlists(self):
+        backoff = Backoff()
+        while True:
+            try:
+                return self.create_playlists(self.query('listplaylists'))
+            except (OSError, ProtocolError) as e:
+                self.logger.debug("mpd: Couldn't list playlists (" + str(e) + "). Retrying...")
+                sleep(backoff.next())
+
+    def clear(self):
+        self.submit([('clear',)])
+
+    def previous(self):
+        self.submit([('previous',)])
+
+    def next(self):
+        self.submit([('next',)])
+
+    def play(self):
+        self.submit([('play',)])
+
+    def pause(self):
+        self.submit([('pause', 1)])  # not just 'pause', that toggles
+
+    def stop(self):
+        self.submit([('stop',)])
+
+    def setvol(self, v):
+        self.submit([('setvol', v)])
+
+    def load(self, playlist):
+        self.submit([('load', playlist)])
+
+    def batch(self, commands):
+        self.submit(commands)
+
+    def currentsong(self):
+        return self.query('currentsong')
+
+    def status(self):
+        """ no network traffic at all: the snapshot kept up to date by watch() (empty until it has arrived) """
+        with self.lock:
+            status = self.snapshot.copy()
+            if 'elapsed' in status:
+                status['elapsed'] = '%.3f' % self.model.elapsed()
+        return status
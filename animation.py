@@ -0,0 +1,92 @@
+import logging
+from time import monotonic
+
+__author__ = 'jeroen'
+
+
+# easing curves: map the fraction of the duration that has passed (0..1) to the fraction of the way done (0..1)
+
+def linear(t):
+    return t
+
+
+def ease_in(t):
+    return t * t
+
+
+def ease_out(t):
+    return 1 - (1 - t) * (1 - t)
+
+
+def ease_in_out(t):
+    return 2 * t * t if t < 0.5 else 1 - 2 * (1 - t) * (1 - t)
+
+
+class Tween:
+    """ moves a sprite's rect from one position to another in a given time """
+
+    def __init__(self, sprite, start, end, duration, easing=ease_in_out, on_done=None, now=None):
+        """ :param on_done: called (without arguments) when the sprite has arrived """
+        self.sprite = sprite
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.easing = easing
+        self.on_done = on_done
+        self.started = monotonic() if now is None else now
+
+    def update(self, now):
+        """ :return: True when done """
+        t = min(1.0, (now - self.started) / self.duration) if self.duration > 0 else 1.0
+        f = self.easing(t)
+        position = (int(round(self.start[0] + (self.end[0] - self.start[0]) * f)),
+                    int(round(self.start[1] + (self.end[1] - self.start[1]) * f)))
+        if position != tuple(self.sprite.rect.topleft):
+            self.sprite.rect.topleft = position
+            self.sprite.dirty = max(self.sprite.dirty, 1)
+        return t >= 1.0
+
+
+class Animator:
+    """
+    The animations that are running. Only the sprites in here are touched by update(), which computes where they
+    should be from the time that has passed (not the number of frames).
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.active = {}  # sprite --> Tween
+
+    def move(self, sprite, end, duration, easing=ease_in_out, on_done=None):
+        """ start moving sprite from where it is now to end (replacing the animation it may have already) """
+        self.active[sprite] = Tween(sprite, tuple(sprite.rect.topleft), tuple(end), duration, easing, on_done)
+
+    def then(self, sprite, on_done):
+        """ call on_done (without arguments) when sprite has arrived: right away if it isn't moving """
+        tween = self.active.get(sprite)
+        if tween is None:
+            on_done()
+        elif tween.on_done:
+            first = tween.on_done
+            tween.on_done = lambda: (first(), on_done())
+        else:
+            tween.on_done = on_done
+
+    def stop(self, sprite):
+        self.active.pop(sprite, None)
+
+    def is_animating(self, sprite=None):
+        return sprite in self.active if sprite is not None else bool(self.active)
+
+    def update(self, now=None):
+        if now is None:
+            now = monotonic()
+        for sprite, tween in list(self.active.items()):
+            if tween.update(now):
+                if self.active.get(sprite) is tween:
+                    del self.active[sprite]
+                if tween.on_done:
+                    tween.on_done()
+
+
+animations = Animator()  # used by all sprites, there's only one scene on the screen at a time
@@ -0,0 +1,30 @@
+import pygame
+
+__author__ = 'jeroen'
+
+
+# custom pygame event types (pygame.USEREVENT itself is left alone, older code used it for click events)
+MPD_IDLE = pygame.USEREVENT + 1  # attributes: changed --> list of mpd subsystems that changed,
+                                 # playlists --> new result of listplaylists (only if 'stored_playlist' changed)
+MPD_COMMAND = pygame.USEREVENT + 2  # attributes: command, args, count, result, error (None if successful)
+MPD_CONNECTION = pygame.USEREVENT + 3  # attributes: connected --> False if mpd has become unreachable
+REDRAW = pygame.USEREVENT + 4  # no attributes: something changed in another thread, the scene must be drawn again
+
+
+waker = None  # called after every post, to wake up the main loop if it's waiting for something else
+
+
+def set_waker(callback):
+    global waker
+    waker = callback
+
+
+def post(event_type, **attributes):
+    """ post a custom event on the pygame event queue, safe to call from any thread """
+    try:
+        pygame.event.post(pygame.event.Event(event_type, **attributes))
+    except pygame.error:
+        # display not initialized (yet): nobody is listening anyway
+        return
+    if waker:
+        waker()
@@ -0,0 +1,144 @@
+import heapq
+import logging
+from collections import deque
+from time import monotonic
+
+import pygame
+
+__author__ = 'jeroen'
+
+
+class Gesture:
+    PRESS = 'press'  # finger down (right away, e.g. to stop a moving list)
+    RELEASE = 'release'  # finger up again without dragging (right away, tap or not)
+    TAP = 'tap'  # finger down and up again without moving (or long pressing)
+    LONG_PRESS = 'long_press'  # finger down for a while without moving
+    DRAG = 'drag'  # finger moving (every motion once it has moved far enough), rel --> distance since last DRAG
+    FLING = 'fling'  # finger released after dragging, velocity --> pixels per second (0 if the finger stood still)
+
+    def __init__(self, kind, pos, rel=(0, 0), velocity=(0.0, 0.0), latency=0.0):
+        """ :param latency: seconds between the input that decided the gesture and the gesture being reported """
+        self.kind = kind
+        self.pos = pos
+        self.rel = rel
+        self.velocity = velocity
+        self.latency = latency
+
+    def __str__(self):
+        return self.kind + ' ' + str(self.pos)
+
+
+class GestureRecognizer:
+    """
+    Turns mouse (touchscreen) events into gestures. The PiTFT is not very accurate: while swiping, we get spurious
+    mouse-motion events, so a finger only starts dragging once it has moved further than move_threshold. A tap is
+    reported as soon as the finger is released, so quick repeated taps all count. Pending long presses are kept in a
+    heap of deadlines, which must be serviced with tick() once per frame.
+    """
+    move_threshold = 10  # pixels: a finger that moves further than this is dragging
+    long_press_time = 0.6  # seconds
+    velocity_window = 0.1  # seconds: only the motion of the finger during this time counts for the velocity
+    stats_interval = 100  # log the latency statistics after this many gestures
+
+    def __init__(self, name='gestures'):
+        self.logger = logging.getLogger(self.__class__.__name__ + '.' + name)
+        self.deadlines = []  # heap of tuples (time, generation, kind, pos, time of the deciding input)
+        self.generation = 0  # deadlines of older generations have been cancelled
+        self.down = None  # where the finger went down, as long as it hasn't moved (too far)
+        self.dragging = False
+        self.long_pressed = False
+        self.samples = deque()  # tuples (time, pos) while dragging
+        self.stats = {}  # kind --> tuple (count, total latency, max latency)
+        self.count = 0
+
+    def feed(self, event, now=None):
+        """ :return: list of the gestures that are recognized right away """
+        if now is None:
+            now = monotonic()
+        gestures = []
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            self.cancel()
+            self.down = event.pos
+            self.dragging = False
+            self.long_pressed = False
+            self.samples.clear()
+            self.samples.append((now, event.pos))
+            self.schedule(now + self.long_press_time, Gesture.LONG_PRESS, event.pos, now)
+            gestures.append(self.report(Gesture(Gesture.PRESS, event.pos), now, now))
+        elif event.type == pygame.MOUSEMOTION and (self.down or self.dragging):
+            if not self.dragging and (abs(self.down[0] - event.pos[0]) > self.move_threshold
+                                      or abs(self.down[1] - event.pos[1]) > self.move_threshold):
+                self.cancel()  # no long press or tap
+                self.dragging = True
+                rel = event.pos[0] - self.down[0], event.pos[1] - self.down[1]  # the part below the threshold too
+                self.down = None
+            else:
+                rel = event.rel
+            self.samples.append((now, event.pos))
+            while len(self.samples) > 2 and self.samples[0][0] < now - self.velocity_window:
+                self.samples.popleft()
+            if self.dragging:
+                gestures.append(self.report(Gesture(Gesture.DRAG, event.pos, rel=rel), now, now))
+        elif event.type == pygame.MOUSEBUTTONUP:
+            if self.dragging:
+                velocity = self.velocity(now)
+                gestures.append(self.report(Gesture(Gesture.FLING, event.pos, velocity=velocity), now, now))
+            else:
+                gestures.append(self.report(Gesture(Gesture.RELEASE, event.pos), now, now))
+                self.cancel()  # no long press any more
+                if self.down and not self.long_pressed:
+                    gestures.append(self.report(Gesture(Gesture.TAP, self.down), now, now))
+            self.down = None
+            self.dragging = False
+        return gestures
+
+    def tick(self, now=None):
+        """ :return: list of the gestures whose deadline has passed """
+        if now is None:
+            now = monotonic()
+        gestures = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, generation, kind, pos, decided = heapq.heappop(self.deadlines)
+            if generation != self.generation:
+                continue  # cancelled
+            if kind == Gesture.LONG_PRESS:
+                self.long_pressed = True
+            gestures.append(self.report(Gesture(kind, pos), decided, now))
+        return gestures
+
+    def next_deadline(self):
+        """ :return: time at which tick() may have something to report, None if nothing is pending """
+        while self.deadlines and self.deadlines[0][1] != self.generation:
+            heapq.heappop(self.deadlines)
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def schedule(self, deadline, kind, pos, decided):
+        heapq.heappush(self.deadlines, (deadline, self.generation, kind, pos, decided))
+
+    def cancel(self):
+        """ forget about a pending long press """
+        self.generation += 1
+
+    def velocity(self, now):
+        recent = [(t, p) for (t, p) in self.samples if t >= now - self.velocity_window]
+        self.samples.clear()
+        if len(recent) < 2 or recent[-1][0] <= recent[0][0]:
+            return 0.0, 0.0
+        dt = recent[-1][0] - recent[0][0]
+        return (recent[-1][1][0] - recent[0][1][0]) / dt, (recent[-1][1][1] - recent[0][1][1]) / dt
+
+    def report(self, gesture, decided, now):
+        gesture.latency = now - decided
+        count, total, maximum = self.stats.get(gesture.kind, (0, 0.0, 0.0))
+        self.stats[gesture.kind] = count + 1, total + gesture.latency, max(maximum, gesture.latency)
+        if gesture.kind != Gesture.DRAG:
+            self.logger.debug("%s recognized after %.0f ms", gesture, 1000 * gesture.latency)
+            self.count += 1
+            if self.count % self.stats_interval == 0:
+                self.logger.info("gestures: " + str(self))
+        return gesture
+
+    def __str__(self):
+        return ', '.join('%s: %d (latency avg %.0f ms, max %.0f ms)' % (kind, count, 1000 * total / count,
+                                                                        1000 * maximum)
+                         for kind, (count, total, maximum) in sorted(self.stats.items()))
@@ -1,20 +1,44 @@
-from queue import Queue
-from threading import Thread
+from threading import Thread, Lock, Condition
+from collections import deque, OrderedDict
+import heapq
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import time
+import struct
+import hashlib
+import weakref
+import tempfile
 import pygame, logging
 
+try:
+    from PIL import Image
+except ImportError:
+    # no Pillow: all images are decoded at full size by pygame
+    Image = None
 
-def resize_to_fill(base_img, size):
-    return __resize(base_img, size, max)
 
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'piradio')
 
-def resize_to_fit(base_img, size):
-    return __resize(base_img, size, min)
 
+def resize_to_fill(base_img, size, smooth=True):
+    """ :param smooth: False for a quick (but blocky) preview """
+    return __resize(base_img, size, max, smooth)
 
-def __resize(base_img, size, strategy):
+
+def resize_to_fit(base_img, size, smooth=True):
+    return __resize(base_img, size, min, smooth)
+
+
+def __resize(base_img, size, strategy, smooth=True):
     base_size = base_img.get_size()
     scale_factor = strategy(float(size[0]) / base_size[0], float(size[1]) / base_size[1])
-    img = pygame.transform.rotozoom(base_img, 0, scale_factor)
+    if smooth:
+        img = pygame.transform.rotozoom(base_img, 0, scale_factor)
+    else:
+        img = pygame.transform.scale(base_img, (max(1, int(base_size[0] * scale_factor)),
+                                                max(1, int(base_size[1] * scale_factor))))
     final_size = img.get_size()
     position = ((size[0] - final_size[0]) / 2, (size[1] - final_size[1]) / 2)
 
@@ -25,37 +49,699 @@ def __resize(base_img, size, strategy):
     return img, position
 
 
+def render_background(cover, size, smooth=True):
+    """ :return: cover scaled to fill size, on a surface of exactly that size (to be drawn with a single blit) """
+    image, position = resize_to_fill(cover, size, smooth)
+    background = pygame.Surface(size).convert()
+    background.blit(image, position)
+    return background
+
+
+def scale_down(base_img, size):
+    """ scale down (never up) to fill size """
+    base_size = base_img.get_size()
+    scale_factor = max(size[0] / base_size[0], size[1] / base_size[1])
+    if scale_factor < 1:
+        logging.getLogger('image_tools').debug('scale down factor ' + str(scale_factor))
+        return pygame.transform.rotozoom(base_img, 0, scale_factor)
+    else:
+        return base_img
+
+
+def scale(base_img, size, kind):
+    """ :param kind: 'fill' (scale down to fill size) or 'fit' (scale to fit in size) """
+    if kind == 'fill':
+        return scale_down(base_img, size)
+    return resize_to_fit(base_img, size)[0]
+
+
+def load_image(filename, size=None):
+    """
+    Load an image, not necessarily at full size. A JPEG can be decoded at 1/2, 1/4 or 1/8 of its size, which skips most
+    of the decoding work: the largest reduction is used that still leaves the image at least as large as size.
+    Other formats (or no Pillow, or no size) are decoded at full size.
+    """
+    if size and Image:
+        try:
+            with Image.open(filename) as img:
+                if img.format == 'JPEG':
+                    img.draft('RGB', (int(size[0]), int(size[1])))
+                    img = img.convert('RGB')
+                    return pygame.image.frombuffer(img.tobytes(), img.size, 'RGB')
+        except (OSError, ValueError) as e:
+            logging.getLogger('image_tools').debug("Pillow can't decode " + filename + " (" + str(e) + ")")
+    return pygame.image.load(filename)
+
+
+def largest(variants):
+    """ :return: size that is at least as large as the size of every variant, None for full size """
+    if any(size is None for size, _ in variants):
+        return None
+    return max(size[0] for size, _ in variants), max(size[1] for size, _ in variants)
+
+
+def decode_raw(filename, variants):
+    """
+    Decode an image and scale it to one or more sizes. Meant to run in a worker process, so it returns raw RGBA pixels
+    (surfaces can't be pickled) and doesn't need a display.
+    :param variants: list of tuples (size, kind)
+    :return: list of tuples (pixels, size), one for every variant
+    """
+    image = load_image(filename, largest(variants))
+    result = []
+    for size, kind in variants:
+        scaled = scale(image, size, kind) if size else image
+        result.append((pygame.image.tostring(scaled, 'RGBA'), scaled.get_size()))
+    return result
+
+
+class ThumbnailCache:
+    """
+    Scaled down images on disk, stored as raw pixels so they can be loaded with pygame.image.frombuffer, without any
+    decoding. An entry is keyed by the (resolved) path and modification time of the original image and the target size.
+    The hashes of the contents of the originals are kept as well, so they don't have to be read again to find copies.
+    """
+    header = struct.Struct('<4sHH')  # pixel format, width, height
+    pixel_format = 'RGBA'
+
+    def __init__(self, directory=cache_dir):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.directory = directory
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            self.logger.warning("can't create thumbnail cache " + directory + ": " + str(e))
+
+    def key(self, filename, size, kind):
+        """
+        :param kind: how the image was scaled to size, e.g. 'fit' or 'fill'
+        :return: file name of the cache entry
+        """
+        identity = '%s|%f|%dx%d|%s' % (os.path.realpath(filename), os.path.getmtime(filename), size[0], size[1], kind)
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest() + '.raw'
+
+    def load(self, key):
+        """ :return: the cached surface, None if not in the cache (or if the entry is corrupt) """
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            pixel_format, width, height = self.header.unpack_from(data)
+            return pygame.image.frombuffer(data[self.header.size:], (width, height), pixel_format.decode('ascii'))
+        except (struct.error, ValueError, pygame.error) as e:
+            self.logger.warning("corrupt cache entry " + path + " (" + str(e) + "), removing it")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def save(self, key, surface):
+        self.__write(key, self.header.pack(self.pixel_format.encode('ascii'), surface.get_width(), surface.get_height())
+                     + pygame.image.tostring(surface, self.pixel_format))
+
+    @staticmethod
+    def digest_key(identity):
+        """ :param identity: tuple (resolved path, modification time, size) of the original image """
+        return hashlib.sha1(('%s|%f|%d' % identity).encode('utf-8')).hexdigest() + '.sha1'
+
+    def load_digest(self, identity):
+        """ :return: the hash of the contents of the original image, None if not in the cache """
+        try:
+            with open(os.path.join(self.directory, self.digest_key(identity)), 'rb') as f:
+                digest = f.read().decode('ascii', 'replace')
+        except OSError:
+            return None
+        return digest if len(digest) == 40 else None  # (a corrupt entry is overwritten by the next save_digest)
+
+    def save_digest(self, identity, digest):
+        self.__write(self.digest_key(identity), digest.encode('ascii'))
+
+    def __write(self, key, data):
+        path = os.path.join(self.directory, key)
+        tmp = None
+        try:
+            # a temporary file of our own: other workers may be writing the same entry
+            with tempfile.NamedTemporaryFile(dir=self.directory, prefix=key + '.', suffix='.tmp', delete=False) as f:
+                tmp = f.name
+                f.write(data)
+            os.replace(tmp, path)  # never leave a half written entry behind
+        except OSError as e:
+            self.logger.warning("can't write " + path + ": " + str(e))
+            if tmp:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+
+class LoaderStats:
+    """ timing of the jobs handled by a Loader, and how often they could use what was loaded before """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.jobs = 0
+        self.decoded = 0  # jobs that needed decoding, i.e. not everything was in the cache
+        self.path_hits = 0  # jobs that found images in use for the same file (resolved path)
+        self.content_hits = 0  # images shared with an earlier job for the same contents (same file or a copy)
+        self.wait_time = 0.0  # total time jobs spent in the queue
+        self.load_time = 0.0  # total time spent loading
+        self.max_load_time = 0.0
+
+    def record(self, wait_time, load_time, decoded):
+        with self.lock:
+            self.jobs += 1
+            self.decoded += 1 if decoded else 0
+            self.wait_time += wait_time
+            self.load_time += load_time
+            self.max_load_time = max(self.max_load_time, load_time)
+
+    def record_hits(self, path_hit, content_hits):
+        with self.lock:
+            self.path_hits += 1 if path_hit else 0
+            self.content_hits += content_hits
+
+    def __str__(self):
+        with self.lock:
+            jobs = max(self.jobs, 1)
+            return '%d jobs (%d decoded), load time: avg %.1f ms, max %.1f ms, queue time: avg %.1f ms, ' \
+                   '%d path hits, %d shared images' % (
+                       self.jobs, self.decoded, 1000 * self.load_time / jobs, 1000 * self.max_load_time,
+                       1000 * self.wait_time / jobs, self.path_hits, self.content_hits)
+
+
+class Job:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, filename, callback, with_thumb, priority):
+        self.filename = filename
+        self.callback = callback
+        self.with_thumb = with_thumb
+        self.priority = priority
+        self.state = None
+        self.queued_at = None
+
+    def __str__(self):
+        return 'Job(' + self.filename + ', priority=' + str(self.priority) + ', ' + str(self.state) + ')'
+
+
+class JobQueue:
+    """
+    Priority queue of jobs: lowest priority value first, first come first served for equal priorities.
+    The priority of a waiting job can be changed, and it can be cancelled.
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.heap = []  # entries (priority, sequence number, job), entries that no longer match the job are skipped
+        self.counter = itertools.count()
+        self.queued = 0
+        self.unfinished = 0  # queued + running
+
+    def put(self, job):
+        with self.condition:
+            job.state = Job.QUEUED
+            job.queued_at = time.monotonic()
+            self.queued += 1
+            self.unfinished += 1
+            self.__push(job)
+
+    def get(self):
+        """ :return: the most urgent job, blocks until there is one """
+        with self.condition:
+            while True:
+                while not self.heap:
+                    self.condition.wait()
+                priority, _, job = heapq.heappop(self.heap)
+                if job.state == Job.QUEUED and job.priority == priority:
+                    job.state = Job.RUNNING
+                    self.queued -= 1
+                    return job
+
+    def reprioritize(self, job, priority):
+        with self.condition:
+            if job.state == Job.QUEUED and job.priority != priority:
+                job.priority = priority
+                self.__push(job)
+                if len(self.heap) > 4 * self.queued + 16:
+                    # too many outdated entries: clean up
+                    self.heap = [e for e in self.heap if e[2].state == Job.QUEUED and e[2].priority == e[0]]
+                    heapq.heapify(self.heap)
+
+    def cancel(self, job):
+        with self.condition:
+            if job.state == Job.QUEUED:
+                job.state = Job.CANCELLED
+                self.queued -= 1
+                self.__finished()
+
+    def task_done(self, job):
+        with self.condition:
+            job.state = Job.DONE
+            self.__finished()
+
+    def join(self):
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def __push(self, job):
+        heapq.heappush(self.heap, (job.priority, next(self.counter), job))
+        self.condition.notify_all()
+
+    def __finished(self):
+        self.unfinished -= 1
+        if not self.unfinished:
+            self.condition.notify_all()
+
+
+class Mailbox:
+    """
+    Results handed over from worker threads to the pygame thread. Posting is an append to a deque, draining doesn't
+    need any locks. The pygame thread drains the mailbox once per frame, within a time budget: when lots of results
+    come in at once, they're spread over several frames.
+    """
+
+    def __init__(self, notify=None):
+        """ :param notify: called (in the worker thread) when something is posted in an empty mailbox """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.messages = deque()  # tuples (callback, args)
+        self.lock = Lock()  # (only for posting)
+        self.notify = notify
+
+    def post(self, callback, *args):
+        # the length is checked after the append, under a lock for the other posters: whatever the pygame thread does
+        # in the meantime, the post that makes the mailbox non-empty is the one that notifies
+        with self.lock:
+            self.messages.append((callback, args))
+            first = len(self.messages) == 1
+        if first and self.notify:
+            self.notify()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def drain(self, budget=None):
+        """
+        call the callbacks of the messages, in the order they were posted
+        :param budget: seconds to spend at most (at least one message is handled), None to handle all of them
+        :return: number of messages handled
+        """
+        deadline = time.monotonic() + budget if budget is not None else None
+        handled = 0
+        while self.messages:
+            callback, args = self.messages.popleft()
+            try:
+                callback(*args)
+            except Exception as e:
+                self.logger.exception("error in " + str(callback) + ": " + str(e))
+            handled += 1
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        if self.messages:
+            self.logger.debug("handled %d messages, %d left for the next frame", handled, len(self.messages))
+        return handled
+
+
 class Loader:
-    def __init__(self, size=None):
+    default_priority = 100  # lower is more urgent
+
+    def __init__(self, size=None, thumb_size=None, cache=None, workers=None, processes=False, mailbox=None):
+        """
+        :param size: images are scaled down to fill this size (e.g. the screen)
+        :param thumb_size: size of the thumbnails, for jobs that ask for one
+        :param cache: ThumbnailCache for the scaled images (None: no caching)
+        :param workers: number of worker threads (default: one per cpu core)
+        :param processes: if set, images are decoded in worker processes instead of worker threads
+        :param mailbox: if set, the callbacks are posted here instead of being called in the worker threads
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.queue = Queue()
+        self.mailbox = mailbox
+        self.queue = JobQueue()
         self.size = size
-        thread = Thread(target=self.__load)
-        thread.setDaemon(True)
-        thread.start()
+        self.thumb_size = thumb_size
+        self.cache = cache
+        self.stats = LoaderStats()
+        self.lock = Lock()
+        self.digests = {}  # identity (see __identity) --> hash of the contents of the file, as far as it's known
+        # tuples (identity, size, kind) and (hash, size, kind) --> image, as long as it's used
+        self.shared = weakref.WeakValueDictionary()
+
+        workers = workers or os.cpu_count() or 1
+        self.pool = None
+        if processes:
+            # 'spawn': forking a process that has initialized SDL (and is running threads) is asking for trouble
+            self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        for _ in range(workers):
+            thread = Thread(target=self.__load)
+            thread.setDaemon(True)
+            thread.start()
 
     def __load(self):
         while True:
-            filename, callback = self.queue.get()
-            self.logger.debug("Worker.__load(filename=" + filename + ")")
-            callback(self.__scale_down(pygame.image.load(filename).convert_alpha()))
-            self.queue.task_done()
+            job = self.queue.get()
+            self.logger.debug("Worker.__load(" + str(job) + ")")
+            started_at = time.monotonic()
+            try:
+                images, decoded = self.__load_images(job.filename, job.with_thumb)
+                self.stats.record(started_at - job.queued_at, time.monotonic() - started_at, decoded)
+                if self.mailbox is not None:
+                    self.mailbox.post(job.callback, *images)
+                else:
+                    job.callback(*images)
+            except (pygame.error, OSError) as e:
+                self.logger.warning("can't load " + job.filename + ": " + str(e))
+            except Exception as e:
+                self.logger.exception("error while loading " + job.filename + ": " + str(e))  # keep the worker alive
+            finally:
+                self.queue.task_done(job)
+            if self.queue.unfinished == 0:
+                self.logger.info("all work done: " + str(self.stats))
+
+    def __load_images(self, filename, with_thumb):
+        """ :return: tuple (list of images, True if decoding was needed) """
+        variants = [(self.size, 'fill')]
+        if with_thumb:
+            variants.append((self.thumb_size, 'fit'))
+
+        # images that are in use already: for another playlist with the same cover file (found by its identity), or
+        # an identical copy of it (found by the hash of its contents, if it's known already)
+        identity = self.__identity(filename)
+        with self.lock:
+            digest = self.digests.get(identity)
+            images = [self.shared.get((identity, size, kind)) for size, kind in variants]
+        path_hits = len(variants) - images.count(None)
+        if digest is None and path_hits < len(variants) and self.cache:
+            digest = self.cache.load_digest(identity)
+            if digest is not None:
+                with self.lock:
+                    self.digests[identity] = digest
+        if digest is not None:
+            with self.lock:
+                for i, (size, kind) in enumerate(variants):
+                    if images[i] is None:
+                        images[i] = self.shared.get((digest, size, kind))
+        todo = [i for i, image in enumerate(images) if image is None]
+
+        keys = [self.cache.key(filename, size, kind) if self.cache and size and i in todo else None
+                for i, (size, kind) in enumerate(variants)]
+        for i in todo:
+            image = self.cache.load(keys[i]) if keys[i] else None
+            images[i] = image.convert_alpha() if image else None
+        missing = [i for i in todo if images[i] is None]
+        if missing and digest is None:
+            # reading and hashing the whole file is only worth it when it has to be decoded anyway
+            digest = self.__digest(identity)
+            with self.lock:
+                for i in missing:
+                    images[i] = self.shared.get((digest,) + variants[i])
+            shared = [i for i in missing if images[i] is not None]
+            for i in shared:
+                if keys[i]:
+                    self.cache.save(keys[i], images[i])  # next time, no need to read the file even if i isn't in use
+            todo = [i for i in todo if i not in shared]
+            missing = [i for i in missing if i not in shared]
+        self.stats.record_hits(path_hits > 0, len(variants) - len(todo))
+        if missing:
+            decoded = self.__decode(filename, [variants[i] for i in missing])
+            for i, image in zip(missing, decoded):
+                images[i] = image
+                if keys[i]:
+                    self.cache.save(keys[i], image)
+        with self.lock:
+            for i in todo:  # another worker may have been first
+                if digest is not None:
+                    images[i] = self.shared.setdefault((digest,) + variants[i], images[i])
+                images[i] = self.shared.setdefault((identity,) + variants[i], images[i])
+        return images, bool(missing)
 
-    def add_work(self, filename, callback):
-        self.logger.debug("Worker.add_work(filename=" + filename + ")")
-        self.queue.put((filename, callback))
+    @staticmethod
+    def __identity(filename):
+        """ :return: tuple (resolved path, modification time, size): the same for all paths to the file """
+        resolved = os.path.realpath(filename)
+        stat = os.stat(resolved)
+        return resolved, stat.st_mtime, stat.st_size
+
+    def __digest(self, identity):
+        """ :return: hash of the contents of the file, the same for identical copies of it """
+        with open(identity[0], 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        with self.lock:
+            self.digests[identity] = digest
+        if self.cache:
+            self.cache.save_digest(identity, digest)
+        return digest
+
+    def __decode(self, filename, variants):
+        if self.pool:
+            raw = self.pool.submit(decode_raw, filename, variants).result()
+            return [pygame.image.frombuffer(pixels, size, 'RGBA').convert_alpha() for pixels, size in raw]
+        original = load_image(filename, largest(variants)).convert_alpha()
+        return [scale(original, size, kind) if size else original for size, kind in variants]
+
+    def add_work(self, filename, callback, with_thumb=False, priority=default_priority):
+        """
+        :param callback: called with the loaded image (and the thumbnail, if with_thumb is set)
+        :param priority: jobs with a lower value are handled first
+        :return: the Job, to change its priority or cancel it later on
+        """
+        self.logger.debug("Worker.add_work(filename=" + filename + ", priority=" + str(priority) + ")")
+        job = Job(filename, callback, with_thumb, priority)
+        self.queue.put(job)
+        return job
+
+    def prioritize(self, job, priority):
+        self.queue.reprioritize(job, priority)
+
+    def cancel(self, job):
+        self.queue.cancel(job)
+
+    def thumb_key(self, filename):
+        """ :return: key of the thumbnail of filename in the cache, None if not available """
+        if not self.cache or not self.thumb_size:
+            return None
+        try:
+            return self.cache.key(filename, self.thumb_size, 'fit')
+        except OSError:
+            return None
+
+    def load_cached(self, key):
+        """ :return: image from the cache, None if not (or no longer) available """
+        image = self.cache.load(key) if self.cache and key else None
+        return image.convert_alpha() if image else None
+
+    def depth(self):
+        """ :return: number of jobs waiting to be handled """
+        return self.queue.queued
 
     def join(self):
         self.queue.join()
 
-    def __scale_down(self, base_img):
-        if not self.size:
-            return base_img
-        base_size = base_img.get_size()
-        scale_factor = max(self.size[0] / base_size[0], self.size[1] / base_size[1])
-        if scale_factor < 1:
-            self.logger.debug('scale down factor ' + str(scale_factor))
-            return pygame.transform.rotozoom(base_img, 0, scale_factor)
+
+class CoverCache:
+    """
+    Decoded covers (and thumbnails), within a budget of bytes: every image counts for width x height x bytes per
+    pixel. When the budget is exceeded, the least recently used images are evicted, except the pinned ones (e.g. the
+    visible and the playing covers). An evicted image has to be loaded again: from the ThumbnailCache on disk, if it's
+    there.
+    """
+    default_budget = 32 * 1024 * 1024
+
+    def __init__(self, budget=default_budget):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.budget = budget
+        self.entries = OrderedDict()  # key --> image, least recently used first
+        self.refs = {}  # image --> number of keys it's in the cache for (images can be shared, see Loader)
+        self.bytes = 0
+        self.pins = {}  # key --> number of times it has been pinned
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.over_budget = False  # (only warn once)
+
+    @staticmethod
+    def size_of(image):
+        width, height = image.get_size()
+        return width * height * image.get_bytesize()
+
+    def get(self, key):
+        """ :return: the image, None if it isn't (or no longer) in the cache """
+        image = self.entries.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return image
+
+    def peek(self, key):
+        """ :return: the image, None if it isn't in the cache. Unlike get(), this doesn't count as a use. """
+        return self.entries.get(key)
+
+    def put(self, key, image):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.__release(old)
+        self.entries[key] = image
+        self.refs[image] = self.refs.get(image, 0) + 1
+        if self.refs[image] == 1:
+            self.bytes += self.size_of(image)  # shared images only count once
+        self.evict()
+
+    def __release(self, image):
+        count = self.refs.pop(image) - 1
+        if count:
+            self.refs[image] = count
+        else:
+            self.bytes -= self.size_of(image)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def pin(self, key):
+        """ keep the image of key (once it's there), until it's unpinned as many times as it's been pinned """
+        self.pins[key] = self.pins.get(key, 0) + 1
+
+    def unpin(self, key):
+        count = self.pins.get(key, 0) - 1
+        if count > 0:
+            self.pins[key] = count
         else:
-            return base_img
+            self.pins.pop(key, None)
+            self.evict()
+
+    def evict(self):
+        if self.bytes <= self.budget:
+            self.over_budget = False
+            return
+        for key in [key for key in self.entries if key not in self.pins]:  # least recently used first
+            self.__release(self.entries.pop(key))
+            self.evictions += 1
+            if self.bytes <= self.budget:
+                break
+        self.logger.debug("evicted covers: " + str(self))
+        if self.bytes > self.budget and not self.over_budget:
+            self.logger.warning("the pinned covers alone exceed the budget: " + str(self))
+        self.over_budget = self.bytes > self.budget
+
+    def __str__(self):
+        return '%d images (%d distinct), %.1f of %.1f MB, %d pinned, %d hits, %d misses, %d evictions' % (
+            len(self.entries), len(self.refs), self.bytes / 1048576.0, self.budget / 1048576.0, len(self.pins),
+            self.hits, self.misses, self.evictions)
+
+
+class Backgrounds:
+    """
+    Full-screen backgrounds (covers scaled to fill the screen) for the player, made by a thread of its own and handed
+    to the pygame thread through the mailbox. The backgrounds of the visible playlists are made before anybody asks
+    for them. The most recently used ones are kept, up to capacity (a 320x240 background takes 300 kB).
+    Backgrounds are keyed by the key of their cover in the CoverCache (not by the cover itself: that may be evicted and
+    loaded again, the background stays valid).
+    """
+    capacity = 24
+
+    def __init__(self, size, mailbox):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.size = size
+        self.mailbox = mailbox
+        self.cache = OrderedDict()  # key --> background, least recently used first
+        self.pending = {}  # key --> list of callbacks waiting for its background (only used by the pygame thread)
+        self.queue = deque()  # tuples (key, copy of the cover) to be rendered
+        self.condition = Condition()
+        self.hits = 0
+        self.misses = 0
+
+        thread = Thread(target=self.__render, name='Backgrounds')
+        thread.setDaemon(True)
+        thread.start()
+
+    def get(self, key, cover, callback=None):
+        """
+        :param key: identifies the cover (see Playlist.image_key)
+        :param callback: called (on the pygame thread) with the background, if it isn't ready yet
+        :return: the background for cover, None if it isn't ready yet
+        """
+        background = self.cache.get(key)
+        if background is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return background
+        self.misses += 1
+        self.logger.debug("background not ready (" + str(self) + ")")
+        callbacks = self.__request(key, cover, urgent=True)
+        if callback:
+            callbacks.append(callback)
+        return None
+
+    def prefetch(self, covers):
+        """
+        make the backgrounds for covers, instead of the ones asked for by an earlier prefetch that haven't been
+        started yet
+        :param covers: list of tuples (key, cover)
+        """
+        with self.condition:
+            dropped = [key for key, _ in self.queue if not self.pending[key]]
+            self.queue = deque(job for job in self.queue if self.pending[job[0]])
+        for key in dropped:
+            del self.pending[key]
+        for key, cover in covers:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            else:
+                self.__request(key, cover)
+
+    def __request(self, key, cover, urgent=False):
+        """ :return: list of callbacks for the background of key """
+        callbacks = self.pending.get(key)
+        with self.condition:
+            if callbacks is None:
+                callbacks = self.pending[key] = []
+                job = (key, cover.copy())  # the pygame thread may be blitting from the cover: don't lock it
+            elif urgent:
+                job = next((job for job in self.queue if job[0] == key), None)  # None: it's being rendered
+                if job:
+                    self.queue.remove(job)
+            else:
+                job = None  # already queued, or being rendered
+            if job:
+                if urgent:
+                    self.queue.appendleft(job)
+                else:
+                    self.queue.append(job)
+                self.condition.notify()
+        return callbacks
+
+    def __render(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                key, copy = self.queue.popleft()
+            started_at = time.monotonic()
+            try:
+                background = render_background(copy, self.size)
+                self.logger.debug("background rendered in %.1f ms", 1000 * (time.monotonic() - started_at))
+            except Exception as e:
+                self.logger.exception("error while rendering a background: " + str(e))  # keep the thread alive
+                background = None
+            self.mailbox.post(self.__rendered, key, background)
+
+    def __rendered(self, key, background):
+        callbacks = self.pending.pop(key, [])
+        if background is None:
+            return
+        self.cache[key] = background
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+        for callback in callbacks:
+            callback(background)
 
+    def __str__(self):
+        return '%d hits, %d misses, %d cached, %d queued' % (self.hits, self.misses, len(self.cache), len(self.queue))
@@ -0,0 +1,104 @@
+import math
+
+__author__ = 'jeroen'
+
+
+class KineticScroller:
+    """
+    Scrolling with momentum, in one dimension. The position follows the finger while dragging. When the finger is
+    released, the position keeps going with the finger's velocity (see gesture.Gesture.FLING) and slows down
+    exponentially, toward a resting point that is snapped to a row. Everything is based on the time passed, not on the
+    number of frames. Once at rest, update() does nothing.
+    """
+    REST, DRAGGING, MOVING = 'rest', 'dragging', 'moving'
+
+    min_velocity = 50  # pixels per second: anything slower is a release without momentum
+    time_constant = 0.325  # seconds: how fast momentum dies out
+    snap_time_constant = 0.1  # seconds: how fast we move to a target without momentum (snap, scroll_to)
+    rest_distance = 0.5  # pixels: closer than this to the target is close enough
+
+    def __init__(self, minimum, maximum, snap=None):
+        """
+        :param minimum, maximum: bounds of the position
+        :param snap: if set, the position comes to rest at a multiple of snap (or at one of the bounds)
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.snap = snap
+        self.position = 0.0
+        self.state = self.REST
+        self.target = 0.0  # where the position comes to rest
+        self.amplitude = 0.0  # distance to the target when the current movement started
+        self.start = 0.0
+        self.tc = self.time_constant
+        self.changed = False  # position changed since the last update()
+
+    def set_bounds(self, minimum, maximum):
+        self.minimum, self.maximum = minimum, maximum
+        self.set_position(self.clamp(self.position))
+        if self.state == self.MOVING:
+            self.state = self.REST  # the target may be out of bounds now: just stop
+        if self.state == self.REST:
+            self.target = self.position
+
+    def clamp(self, position):
+        return max(self.minimum, min(self.maximum, position))
+
+    def snapped(self, position):
+        if self.snap:
+            position = round(position / self.snap) * self.snap
+        return self.clamp(position)
+
+    def is_moving(self):
+        return self.state != self.REST
+
+    def press(self):
+        """ finger down: stop right where we are """
+        self.state = self.DRAGGING
+        self.target = self.position
+
+    def drag(self, distance):
+        """ finger moved over distance """
+        if self.state != self.DRAGGING:
+            self.press()
+        self.set_position(self.clamp(self.position + distance))
+        self.target = self.position
+
+    def release(self, velocity, now):
+        """ finger up: glide on with the velocity of the finger (if any), and come to rest at a row """
+        if abs(velocity) >= self.min_velocity:
+            self.move_to(self.snapped(self.position + velocity * self.time_constant), now, self.time_constant)
+        else:
+            self.move_to(self.snapped(self.position), now, self.snap_time_constant)
+
+    def scroll_to(self, target, now):
+        """ move to target, without momentum """
+        self.move_to(self.snapped(target), now, self.snap_time_constant)
+
+    def move_to(self, target, now, tc):
+        self.target = target
+        self.amplitude = target - self.position
+        self.start = now
+        self.tc = tc
+        self.state = self.MOVING if abs(self.amplitude) >= self.rest_distance else self.REST
+        if self.state == self.REST:
+            self.set_position(target)
+
+    def set_position(self, position):
+        if position != self.position:
+            self.position = position
+            self.changed = True
+
+    def update(self, now):
+        """
+        :return: True if the position has changed since the last update
+        """
+        if self.state == self.MOVING:
+            remaining = self.amplitude * math.exp(-(now - self.start) / self.tc)
+            if abs(remaining) < self.rest_distance:
+                self.set_position(self.target)
+                self.state = self.REST
+            else:
+                self.set_position(self.target - remaining)
+        changed, self.changed = self.changed, False
+        return changed
@@ -3,9 +3,14 @@ import pygame
 import pygame.constants as const
 import argparse
 import logging
+import os
+import signal
+import selectors
 
 from scroll import ScrollPane
 import player
+import events
+from scheduler import jobs
 
 
 class SceneManager:
@@ -23,6 +28,76 @@ class SceneManager:
         self.scene.clear(self.screen)
 
 
+mailbox_budget = 0.008  # seconds per frame to spend on handing out loaded covers
+
+
+class Reactor:
+    """
+    Waits for everything the UI has to react to, all at once: the touchscreen, a wake-up pipe that other threads write
+    to whenever they post an event (mpd's idle results, finished mpd commands, loaded covers) and signals. The UI
+    thread sleeps in select() until one of them needs attention, or until the scene needs its next frame (which
+    covers the scenes' own deadlines, like gestures and animations). Pygame's event queue is read after that.
+    """
+
+    def __init__(self, input_device):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.selector = selectors.DefaultSelector()
+
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.add_reader(self.wake_r, self.drain)
+        signal.set_wakeup_fd(self.wake_w)  # e.g. SIGTERM, which SDL turns into a QUIT event
+
+        # the kernel gives every reader of an input device its own copy of the events: reading ours doesn't take
+        # anything away from SDL, it only tells us there's something to read
+        fd = os.open(input_device, os.O_RDONLY | os.O_NONBLOCK)
+        self.add_reader(fd, self.drain)
+        self.logger.info("waiting for input from " + input_device)
+
+    @classmethod
+    def create(cls, input_device):
+        """ :return: a Reactor, None if we can't watch the input device (then pygame.event.wait must do) """
+        if not input_device or not hasattr(os, 'set_blocking'):
+            return None
+        try:
+            reactor = cls(input_device)
+        except OSError as e:
+            logging.getLogger(cls.__name__).info("can't watch " + input_device + " (" + str(e) + ")")
+            return None
+        events.set_waker(reactor.wake_up)
+        return reactor
+
+    def add_reader(self, fd, callback):
+        """ :param callback: called with fd when there's something to read """
+        self.selector.register(fd, selectors.EVENT_READ, callback)
+
+    def wake_up(self):
+        """ safe to call from any thread """
+        try:
+            os.write(self.wake_w, b'x')
+        except BlockingIOError:
+            pass  # the pipe is full: we'll wake up anyway
+
+    def drain(self, fd):
+        try:
+            while True:
+                if not os.read(fd, 4096):
+                    self.logger.warning("end of input on fd %d, not watching it any more", fd)
+                    self.selector.unregister(fd)
+                    return
+        except BlockingIOError:
+            pass
+
+    def wait(self, timeout=None):
+        """
+        sleep until there's something to read, or timeout seconds have passed
+        :param timeout: None to wait as long as it takes
+        """
+        for key, _ in self.selector.select(timeout):
+            key.data(key.fd)
+
+
 class LoggerFactory:
     def __init__(self, base_get_logger, debugs, infos):
         self.base_get_logger = base_get_logger
@@ -51,6 +126,16 @@ def main():
                         help='enable debug logging for specified loggers')
     parser.add_argument('-i', '--info', metavar='LOGGER', action='append',
                         help='set info logging for specified loggers')
+    parser.add_argument('-b', '--backend', choices=['mpd', 'asyncio'], default='mpd',
+                        help='how to talk to mpd: python-mpd client or built-in asyncio protocol (default: mpd)')
+    parser.add_argument('-f', '--frame-budget', metavar='MS', type=float, default=8,
+                        help='milliseconds per frame for background jobs, like scaling images (default: 8)')
+    parser.add_argument('-m', '--cover-memory', metavar='MB', type=float, default=32,
+                        help='memory for the loaded covers, in MB (default: 32)')
+    parser.add_argument('-w', '--workers', metavar='N', type=int,
+                        help='number of workers loading covers (default: one per cpu core)')
+    parser.add_argument('-p', '--processes', action='store_true',
+                        help='decode covers in worker processes instead of threads (default: threads)')
 
     args = parser.parse_args()
 
@@ -68,13 +153,16 @@ def main():
     logger = logging.getLogger('main')
     logger.info("==== here we go again")
     logger.debug("commandline args: %s", str(args))
+    jobs.budget = args.frame_budget / 1000.0
 
-    mytft = PiTFT(args.stand_alone)
+    mytft = PiTFT(args.stand_alone, args.backend, args.workers, args.processes)
     init_rect = pygame.Rect(mytft.screen.get_rect())
     bg = pygame.Surface(mytft.screen.get_size()).convert()
 
     mympd = mytft.mympd  # PiMPD()
+    mympd.covers.budget = int(args.cover_memory * 1024 * 1024)
     playlists = mympd.init_playlists()
+    mympd.subscribe()
 
     # SCENE 1 -- Playlist selector
     playlist_selector = ScrollPane(playlists, init_rect)
@@ -82,6 +170,7 @@ def main():
     # SCENE 2 -- Player
     myplayer = player.Player(mytft, playlist_selector)
     playlist_selector.player = myplayer
+    playlist_selector.prefetch_backgrounds()
 
     # scene manager
     manager = SceneManager(mytft.screen, playlist_selector)
@@ -91,15 +180,35 @@ def main():
     mytft.screen.blit(bg, origin)
 
     pygame.display.flip()
+    reactor = Reactor.create(mytft.input_device)
     loop = True
     while loop:
         try:
-            mytft.clock_tick()
-            for event in pygame.event.get():
+            delay = manager.scene.next_frame()
+            if mympd.mailbox or jobs:
+                delay = 0  # there are loaded covers to hand out, or jobs to finish
+            if delay == 0:
+                mytft.clock_tick()  # animating, at a capped frame rate
+                pending = pygame.event.get()
+            elif reactor:
+                reactor.wait(delay)  # nothing moves: sleep until something happens, or the scene needs a frame
+                pending = pygame.event.get()
+            else:
+                # nothing moves: sleep until something happens, or until the scene has to be drawn again
+                event = pygame.event.wait() if delay is None else pygame.event.wait(max(1, int(delay * 1000)))
+                pending = [event] + pygame.event.get() if event.type != pygame.NOEVENT else []
+            for event in pending:
                 if event.type == const.K_ESCAPE or event.type is pygame.QUIT:
                     loop = False
                     break
+                if event.type == events.REDRAW:
+                    continue  # only meant to wake us up
+                if event.type == events.MPD_IDLE and getattr(event, 'playlists', None) is not None:
+                    # the playlist selector follows mpd's stored playlists, whatever scene is showing
+                    playlist_selector.set_playlists(mympd.update_playlists(event.playlists))
                 manager.scene.handle(event)
+            mympd.mailbox.drain(mailbox_budget)
+            jobs.run()
             changes = manager.scene.draw(mytft.screen)
             pygame.display.update(changes)
         except Exception as e:
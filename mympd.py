@@ -1,9 +1,15 @@
 import os
+import re
+import json
+import random
 import logging
-from socket import error as SocketError
-from time import sleep
+from socket import error as SocketError, timeout as SocketTimeout
+from threading import Thread, Lock, Event, Condition
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 import pygame
 import image_tools
+import events
 
 try:
     mpd = __import__('mpd')
@@ -18,50 +24,268 @@ paths = {}
 # values for keys 'music_path' and 'playlists_path' are initialized in concrete MyMPD constructors
 
 
+def init_local_paths(mpd_path="/var/lib/mpd/"):
+    """ paths of an mpd server running on this machine """
+    paths['music_path'] = mpd_path + "music/"
+    paths['playlists_path'] = mpd_path + "playlists/"
+
+
+class BatchError(Exception):
+    """ a command in a batch failed, the commands before it have been executed, the ones after it have not """
+
+    def __init__(self, position, command, message):
+        Exception.__init__(self, 'command ' + str(position) + ' ' + str(command) + ' failed: ' + str(message))
+        self.position = position  # 0-based index in the batch
+        self.command = command  # tuple (name, arg1, arg2, ...)
+        self.message = message
+
+
+def read_m3u_header(filename):
+    """
+    Read the '#path=' and '#cover=' lines at the top of an m3u file. The file is read line by line, and reading stops
+    at the first entry (i.e. the first line that is not a comment) or as soon as both lines have been found.
+    :return: dict with keys 'path' and 'cover' (if found)
+    """
+    header = {}
+    with open(filename, 'r', buffering=4096) as f:  # small buffer: usually the header is all we need
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line and not line.startswith('#'):
+                break
+            if line.startswith('#path='):
+                header['path'] = line.partition('=')[2].lstrip('./')
+            elif line.startswith('#cover='):
+                header['cover'] = line.partition('=')[2]
+            if len(header) == 2:
+                break
+    return header
+
+
+def read_m3u_headers(filenames, workers=8):
+    """
+    Read the headers of several m3u files in parallel, which mostly pays off on slow storage (SD card, network share).
+    :return: dict filename --> header (see read_m3u_header), files that can't be read are left out
+    """
+    logger = logging.getLogger('mympd')
+
+    def timed_read(filename):
+        start = monotonic()
+        try:
+            header = read_m3u_header(filename)
+        except OSError as e:
+            logger.warning("can't read " + filename + ": " + str(e))
+            header = None
+        return filename, header, monotonic() - start
+
+    start = monotonic()
+    headers = {}
+    slowest = (None, 0)
+    with ThreadPoolExecutor(workers) as pool:
+        for filename, header, duration in pool.map(timed_read, filenames):
+            logger.debug("read header of %s in %.1f ms: %s", filename, 1000 * duration, header)
+            if header is not None:
+                headers[filename] = header
+            slowest = max(slowest, (filename, duration), key=lambda r: r[1])
+    if filenames:
+        logger.info("read %d m3u headers in %.1f ms (slowest: %s, %.1f ms)", len(filenames),
+                    1000 * (monotonic() - start), slowest[0], 1000 * slowest[1])
+    return headers
+
+
+def m3u_filename(playlist):
+    return os.path.join(paths['playlists_path'], playlist + '.m3u')
+
+
+class PlaylistIndex:
+    """
+    What we know about every playlist (path and cover from the m3u header, and the cache key of its thumbnail), stored
+    on disk. An entry is only valid as long as mpd reports the same 'last-modified' for the playlist.
+    """
+
+    def __init__(self, filename=os.path.join(image_tools.cache_dir, 'playlists.json')):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.filename = filename
+        self.entries = {}
+        self.seen = set()  # playlists that still exist, the others are dropped on save()
+        try:
+            with open(filename, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.info("no usable playlist index (" + str(e) + "), starting from scratch")
+
+    def get(self, playlist, last_modified):
+        """ :return: dict with keys 'path', 'cover' and 'thumb', None if not known or outdated """
+        self.seen.add(playlist)
+        entry = self.entries.get(playlist)
+        if entry and entry['last-modified'] == last_modified:
+            return entry
+        return None
+
+    def put(self, playlist, last_modified, path, cover, thumb):
+        self.seen.add(playlist)
+        self.entries[playlist] = {'last-modified': last_modified, 'path': path, 'cover': cover, 'thumb': thumb}
+
+    def save(self):
+        self.entries = dict((k, v) for k, v in self.entries.items() if k in self.seen)
+        try:
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(self.filename + '.tmp', self.filename)
+        except OSError as e:
+            self.logger.warning("can't write " + self.filename + ": " + str(e))
+
+
 class Playlist:
 
-    def __init__(self, pl_dict, img_loader, def_img):
+    def __init__(self, pl_dict, img_loader, def_img, index=None, header=None, covers=None):
+        """
+        :param index: PlaylistIndex, to look up (and store) the info from the m3u header
+        :param header: the m3u header, if it has been read already (see read_m3u_header)
+        :param covers: CoverCache that keeps the loaded cover and thumbnail
+        """
         self.playlist = pl_dict['playlist']
         self.last_modified = pl_dict['last-modified']
-        self.cover_img = def_img
+        self.def_img = def_img
+        self.covers = covers if covers is not None else image_tools.CoverCache()
+        self.loaded = False  # the cover has been loaded (it may have been evicted from the cache since)
 
         self.listeners = []
+        self.loader = img_loader
+        self.cover_job = None
+        self.cover_file = None
+
+        entry = index.get(self.playlist, self.last_modified) if index else None
+        self.from_index = entry is not None
+        thumb = None
+        if entry:
+            self.path = entry['path']
+            self.cover = entry['cover']
+            thumb = img_loader.load_cached(entry['thumb'])  # good enough until the real one is loaded
+        else:
+            self.set_header(header if header is not None else read_m3u_header(m3u_filename(self.playlist)))
 
-        m3u_file = self.playlist + '.m3u'
-        with open(os.path.join(paths['playlists_path'], m3u_file), 'r') as f:
-            content = f.read()
-            lines = content.split('\n')
-            for l in lines:
-                if l.startswith('#path='):
-                    self.path = l.split('=')[1].lstrip('./')
-                elif l.startswith('#cover='):
-                    self.cover = l.split('=')[1]
-                if hasattr(self, 'path') and hasattr(self, 'cover'):
-                    break  # exit lines-loop
         try:
-            img_loader.add_work(os.path.join(paths['music_path'] + self.path, self.cover), self.set_cover)
+            self.cover_file = os.path.join(paths['music_path'] + self.path, self.cover)
+            if index and not entry:
+                index.put(self.playlist, self.last_modified, self.path, self.cover,
+                          img_loader.thumb_key(self.cover_file))
         except AttributeError:
             pass
-
-    def set_cover(self, cover):
-        self.cover_img = cover
+        self.cover_key = (self.cover_file, 'cover') if self.cover_file else None
+        self.thumb_key = (self.cover_file, 'thumb') if self.cover_file else None
+        if thumb is not None and self.thumb_key:
+            self.covers.put(self.thumb_key, thumb)
+        self.request_cover()
+
+    def set_header(self, header):
+        if 'path' in header:
+            self.path = header['path']
+        if 'cover' in header:
+            self.cover = header['cover']
+
+    # cover_img and thumb_img may be read in every frame: they peek in the cache, only request_cover() counts as a
+    # use of the cover (see ScrollPane.update_priorities)
+
+    @property
+    def cover_img(self):
+        """ the cover, scaled down to fill the screen (the default cover as long as it isn't loaded) """
+        cover = self.covers.peek(self.cover_key) if self.cover_key else None
+        if cover is None:
+            self.reload()
+            return self.def_img
+        return cover
+
+    @property
+    def thumb_img(self):
+        """ the cover scaled down to thumbnail size, None if not loaded """
+        thumb = self.covers.peek(self.thumb_key) if self.thumb_key else None
+        if thumb is None:
+            self.reload()
+        return thumb
+
+    @property
+    def image_key(self):
+        """ identifies the image cover_img is: the key of the cover in the cache, None for the default cover """
+        return self.cover_key if self.cover_key in self.covers else None
+
+    @property
+    def cover_loaded(self):
+        return bool(self.cover_key) and self.cover_key in self.covers\
+            and (self.thumb_key in self.covers or not self.loader.thumb_size)
+
+    def reload(self):
+        """ load the cover again if it has been evicted from the cache (and isn't being loaded already) """
+        state = self.cover_job.state if self.cover_job else None
+        if self.loaded and state not in (image_tools.Job.QUEUED, image_tools.Job.RUNNING) and not self.cover_loaded:
+            self.request_cover()
+
+    def pin(self):
+        """ keep the cover in the cache (e.g. while it's visible or playing), until unpin() """
+        if self.cover_key:
+            self.covers.pin(self.cover_key)
+            self.covers.pin(self.thumb_key)
+
+    def unpin(self):
+        if self.cover_key:
+            self.covers.unpin(self.cover_key)
+            self.covers.unpin(self.thumb_key)
+
+    def request_cover(self, priority=image_tools.Loader.default_priority):
+        """ make sure the cover gets loaded, with the given priority """
+        if not self.cover_file:
+            return
+        cover = self.covers.get(self.cover_key)  # a use of the cover: counted, and it becomes the most recent one
+        thumb = self.covers.get(self.thumb_key) if self.loader.thumb_size else True
+        if cover is not None and thumb is not None:
+            return
+        state = self.cover_job.state if self.cover_job else None
+        if state == image_tools.Job.QUEUED:
+            self.loader.prioritize(self.cover_job, priority)
+        elif state in (None, image_tools.Job.CANCELLED) or (state == image_tools.Job.DONE and self.loaded):
+            # (a job that is done without the cover having been loaded has failed: no point in trying again)
+            self.cover_job = self.loader.add_work(self.cover_file, self.set_cover, with_thumb=True, priority=priority)
+
+    def cancel_cover(self):
+        """ don't load the cover (for now), if it isn't being loaded yet """
+        if self.cover_job:
+            self.loader.cancel(self.cover_job)
+
+    def set_cover(self, cover, thumb=None):
+        self.covers.put(self.cover_key, cover)
+        if thumb is not None:
+            self.covers.put(self.thumb_key, thumb)
+        self.loaded = True
         for l in self.listeners:
             l.playlist_updated()
 
     def add_listener(self, listener):
         self.listeners.append(listener)
 
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
     def __str__(self):
         return "Playlist{'" + self.playlist + "', last_modified: '" + self.last_modified + "', path: '" + self.path\
-               + "', cover: '" + self.cover + "', cover_img: '" + str(self.cover_img) + "'}"
+               + "', cover: '" + self.cover + "', cover_loaded: '" + str(self.cover_loaded) + "'}"
 
 
 class MyMPD:
-    def __init__(self, screen_size=None):
-        self.loader = image_tools.Loader(screen_size)
+    def __init__(self, screen_size=None, thumb_size=None, workers=None, processes=False):
+        """
+        :param thumb_size: size of the thumbnails of the covers (None: no thumbnails), see scroll.calc_img_size
+        :param workers: number of workers loading the covers, processes: decode in processes (see image_tools.Loader)
+        """
+        self.playlists = {}  # name --> Playlist, as last created or updated
+        # the loaded images are handed to the pygame thread, see main
+        self.mailbox = image_tools.Mailbox(notify=lambda: events.post(events.REDRAW))
+        self.covers = image_tools.CoverCache()  # the loaded covers of all playlists
+        self.loader = image_tools.Loader(screen_size, thumb_size, image_tools.ThumbnailCache(), workers, processes,
+                                         mailbox=self.mailbox)
         self.default_cover = None
         self.loader.add_work(filename=os.path.join('player_icons', 'unknown.png'), callback=self.__set_def_img)
         self.loader.join()
+        self.mailbox.drain()
         logging.debug("MyMPD init finished, self.default_cover=" + str(self.default_cover))
 
     def __set_def_img(self, img):
@@ -70,10 +294,72 @@ class MyMPD:
     def connect(self):
         raise NotImplementedError
 
+    def subscribe(self):
+        """ start keeping a local copy of the status up to date, so status() doesn't need to query the server """
+        pass
+
+    def is_connected(self):
+        return True
+
     def init_playlists(self):
         raise NotImplementedError
 
-    # Methods to be propagated to real MPDClient
+    def create_playlists(self, source):
+        """
+        :param source: result of mpd's listplaylists, i.e. a list of dicts with keys 'playlist' and 'last-modified'
+        :return: list of Playlist objects, sorted by name
+        """
+        self.playlists = {}
+        playlists = self.update_playlists(source)
+
+        self.logger.info("%d playlists loaded (%d from the index)", len(playlists),
+                         len([p for p in playlists if p.from_index]))
+
+        return playlists
+
+    def update_playlists(self, source):
+        """
+        Bring the playlists in line with a (new) result of listplaylists. Only the playlists that are new or have
+        another 'last-modified' are (re)created, the others are kept as they are, covers included.
+        :param source: result of mpd's listplaylists, i.e. a list of dicts with keys 'playlist' and 'last-modified'
+        :return: list of Playlist objects, sorted by name
+        """
+        source = sorted(source, key=lambda current: current['playlist'])
+        current = self.playlists
+        changed = [pl for pl in source
+                   if pl['playlist'] not in current or current[pl['playlist']].last_modified != pl['last-modified']]
+        changed_names = set(pl['playlist'] for pl in changed)
+        names = set(pl['playlist'] for pl in source)
+        removed = [playlist for name, playlist in current.items() if name not in names]
+
+        index = PlaylistIndex()
+        # only the playlists that have changed since the index was written need to be read
+        misses = [m3u_filename(pl['playlist']) for pl in changed if not index.get(pl['playlist'], pl['last-modified'])]
+        headers = read_m3u_headers(misses)
+
+        playlists = []
+        for pl in source:
+            if pl['playlist'] in changed_names:
+                header = headers.get(m3u_filename(pl['playlist']), {})
+                playlist = Playlist(pl, self.loader, self.default_cover, index, header, self.covers)
+                if pl['playlist'] in current:
+                    current[pl['playlist']].cancel_cover()
+                self.logger.debug("loaded playlist " + str(playlist.playlist))
+            else:
+                playlist = current[pl['playlist']]
+                index.get(playlist.playlist, playlist.last_modified)  # still there: keep it in the index
+            playlists.append(playlist)
+        for playlist in removed:
+            playlist.cancel_cover()
+        if changed or removed:
+            index.save()
+
+        if current:
+            self.logger.info("playlists updated: %d new or changed, %d removed", len(changed), len(removed))
+        self.playlists = dict((playlist.playlist, playlist) for playlist in playlists)
+        return playlists
+
+    # Methods to be propagated to real MPDClient (possibly asynchronously, see CommandWorker)
 
     def clear(self):
         raise NotImplementedError
@@ -99,6 +385,15 @@ class MyMPD:
     def load(self, playlist):
         raise NotImplementedError
 
+    def batch(self, commands):
+        """
+        execute a sequence of commands in one go, in the background (like the other commands): returns right away.
+        When done, a MPD_COMMAND event is posted with command 'command_list', and either result (list with the result
+        of every command) or error (BatchError if one of the commands failed, or a connection error).
+        :param commands: list of tuples (command name, arg1, arg2, ...), e.g. [('stop',), ('load', 'my playlist')]
+        """
+        raise NotImplementedError
+
     def status(self):
         """
         :return dictionary with these keys:
@@ -106,6 +401,7 @@ class MyMPD:
             'song' --> 0-based index of current song in playlist, key not present if not playing
             'nextsong' --> key should not be present if there is no next song
             'elapsed' --> time passed (in seconds)
+            'time' --> total time of the current song (in seconds), key not present if not playing
         """
         raise NotImplementedError
 
@@ -131,8 +427,8 @@ class WinMPD(MyMPD):
     playing = False
     paused = None
 
-    def __init__(self, size=None):
-        MyMPD.__init__(self, size)
+    def __init__(self, size=None, thumb_size=None, workers=None, processes=False):
+        MyMPD.__init__(self, size, thumb_size, workers, processes)
 
         global paths
         base_path = "\\\\DiskStation\\"
@@ -145,22 +441,18 @@ class WinMPD(MyMPD):
         pass
 
     def init_playlists(self):
-        playlists = []
-
-        listdir = os.listdir(paths['playlists_path'])
-        listdir.sort()
-
-        for f in listdir: #[:13]:  # load only 13 playlists
-            if f.endswith('.m3u'):
-                playlist = Playlist({'playlist':f[:-4],'last-modified':'now'}, self.loader, self.default_cover)
-                playlists.append(playlist)
-                self.logger.debug("loaded playlist " + str(playlist.playlist))
-            else:
-                self.logger.debug("no playlist: " + str(f))
-
-        self.logger.info("%d playlists loaded", len(playlists))
+        source = []
+
+        # on windows, scandir gets the modification times along with the names: no extra round trips to the share
+        with os.scandir(paths['playlists_path']) as entries:
+            for f in entries: #[:13]:  # load only 13 playlists
+                if f.name.endswith('.m3u'):
+                    # like mpd, use the modification time of the file as 'last-modified'
+                    source.append({'playlist':f.name[:-4],'last-modified':str(f.stat().st_mtime)})
+                else:
+                    self.logger.debug("no playlist: " + str(f.name))
 
-        return playlists
+        return self.create_playlists(source)
 
     def clear(self):
         self.logger.debug("clear")
@@ -218,6 +510,16 @@ class WinMPD(MyMPD):
         self.logger.debug("load playlist " + str(playlist))
         self.current_playlist = playlist
 
+    def batch(self, commands):
+        results, error = [], None
+        for i, command in enumerate(commands):
+            try:
+                results.append(getattr(self, command[0])(*command[1:]))
+            except SystemError as e:
+                error = BatchError(i, command, e)
+                break
+        CommandWorker.report(Batch(commands), None if error else results, error)
+
     def currentsong(self):
         if self.current_song:
             return {'time':self.song_duration}
@@ -236,6 +538,7 @@ class WinMPD(MyMPD):
             status['song']=str(self.current_song-1)  # -1 want zero-based
             status['track']=self.current_song
             status['title']='Liedje nummer ' + str(self.current_song)
+            status['time']=self.song_duration
             if self.playing:
                 import time
                 now = time.time()
@@ -249,90 +552,528 @@ class WinMPD(MyMPD):
         return status
 
 
+class Backoff:
+    """ exponential backoff with jitter, so reconnecting clients don't all hammer the server at the same moment """
+
+    def __init__(self, initial=0.5, maximum=30.0, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter  # fraction of the delay that is random
+        self.attempts = 0
+
+    def next(self):
+        """ :return: seconds to wait before the next attempt """
+        delay = min(self.initial * self.factor ** self.attempts, self.maximum)
+        self.attempts += 1
+        return delay * random.uniform(1 - self.jitter, 1)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class CircuitBreaker:
+    """
+    Health of the link with mpd, shared by all connections to the same server.
+    CLOSED: all is well. OPEN: mpd is unreachable, don't try to connect until the backoff delay has passed.
+    HALF_OPEN: one connection attempt (the probe) is in progress, the others wait for its outcome.
+    A MPD_CONNECTION event is posted whenever the link goes down or comes back.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, backoff=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.backoff = backoff or Backoff()
+        self.condition = Condition()
+        self.state = self.CLOSED
+        self.retry_at = None
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """ :param listener: function without arguments, called whenever the state changes """
+        self.listeners.append(listener)
+
+    def is_connected(self):
+        return self.state == self.CLOSED
+
+    def allow(self):
+        """ :return: True if a connection attempt may be made now """
+        with self.condition:
+            if self.state == self.OPEN and monotonic() >= self.retry_at:
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def wait_time(self):
+        """ :return: seconds until a connection attempt is allowed again, None if that depends on someone else """
+        with self.condition:
+            if self.state == self.OPEN:
+                return max(self.retry_at - monotonic(), 0)
+            return None
+
+    def wait_until_allowed(self):
+        while not self.allow():
+            with self.condition:
+                self.condition.wait(self.wait_time())
+
+    def succeeded(self):
+        self.__set_state(self.CLOSED)
+
+    def failed(self):
+        self.__set_state(self.OPEN)
+
+    def __set_state(self, state):
+        with self.condition:
+            previous = self.state
+            if previous == state == self.OPEN:
+                return  # the same outage, noticed by another connection: only one step in the backoff
+            self.state = state
+            if state == self.OPEN:
+                delay = self.backoff.next()
+                self.retry_at = monotonic() + delay
+                self.logger.info("mpd unreachable, next attempt in %.1f seconds", delay)
+            else:
+                self.backoff.reset()
+            self.condition.notify_all()
+        # listeners are called without holding the lock, they probably have locks of their own
+        for listener in self.listeners:
+            listener()
+        if (previous == self.CLOSED) != (state == self.CLOSED):
+            events.post(events.MPD_CONNECTION, connected=(state == self.CLOSED))
+
+
+class StatusModel:
+    """
+    Local model of the play position. Every status sample from mpd is recorded together with a monotonic timestamp,
+    so in between samples the elapsed time can be extrapolated without any network traffic.
+    """
+    resync_interval = 30.0  # seconds: while playing, compare with a fresh sample from mpd at least this often
+    max_slew = 1.0  # seconds: a smaller difference with mpd is corrected gradually, a larger one immediately
+    slew_time = 2.0  # seconds: time to gradually correct a small difference
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.state = 'stop'
+        self.song = None
+        self.duration = None
+        self.sample = 0.0  # elapsed time reported by mpd...
+        self.sampled_at = clock()  # ... and when we received it
+        self.correction = 0.0
+
+    def update(self, status):
+        now = self.clock()
+        state = status.get('state', 'stop')
+        song = status.get('songid', status.get('song'))
+        sample = float(status.get('elapsed', 0))
+
+        drift = self.elapsed(now) - sample
+        if state == self.state == 'play' and song == self.song and abs(drift) < self.max_slew:
+            # same song still playing: don't let the progress bar jump back and forth, catch up gradually
+            self.correction = drift
+        else:
+            self.correction = 0.0
+
+        self.state = state
+        self.song = song
+        self.duration = self.parse_duration(status)
+        self.sample = sample
+        self.sampled_at = now
+
+    @staticmethod
+    def parse_duration(status):
+        # 'duration' is only sent by recent mpd versions, 'time' is either the song length (from currentsong)
+        # or 'elapsed:length' (from status)
+        if 'duration' in status:
+            return float(status['duration'])
+        if 'time' in status:
+            return float(str(status['time']).split(':')[-1])
+        return None
+
+    def elapsed(self, now=None):
+        if now is None:
+            now = self.clock()
+        since = now - self.sampled_at
+        elapsed = self.sample
+        if self.state == 'play':
+            elapsed += since
+        if self.correction:
+            elapsed += self.correction * max(0.0, 1 - since / self.slew_time)
+        if self.duration:
+            elapsed = min(elapsed, self.duration)
+        return max(elapsed, 0.0)
+
+    def time_to_resync(self):
+        """ :return: seconds until a fresh sample is needed, None if nothing is moving """
+        if self.state != 'play':
+            return None
+        return max(self.resync_interval - (self.clock() - self.sampled_at), 0.1)
+
+
+class StatusWatcher(Thread):
+    """
+    Keeps a local snapshot of status() + currentsong() up to date. The watcher has its own connection, which spends
+    its time in mpd's 'idle' command: the server is only queried again when it reports that something has changed.
+    The elapsed time in the snapshot is extrapolated by a StatusModel.
+    """
+    subsystems = ('player', 'mixer', 'playlist', 'stored_playlist', 'options')
+    status_subsystems = {'player', 'mixer', 'playlist', 'options'}  # changes that affect the status snapshot
+
+    def __init__(self, host, port, health):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.host = host
+        self.port = port
+        self.health = health  # CircuitBreaker
+
+        self.client = mpd.MPDClient()
+        self.client.timeout = 10
+        self.client.idletimeout = None  # idle blocks until mpd has something to report
+
+        self.lock = Lock()
+        self.snapshot = {}
+        self.model = StatusModel()
+        self.ready = Event()  # set as soon as the first snapshot is available
+
+    def status(self):
+        with self.lock:
+            status = self.snapshot.copy()
+            if 'elapsed' in status:
+                status['elapsed'] = '%.3f' % self.model.elapsed()
+        return status
+
+    def run(self):
+        while True:
+            self.health.wait_until_allowed()
+            try:
+                self.client.connect(self.host, self.port)
+                self.health.succeeded()
+                self.refresh()
+                self.watch()
+            except (mpd.MPDError, SocketError) as e:
+                self.logger.info('mpd: watcher connection lost (' + str(e) + ')')
+                self.health.failed()
+            self.disconnect()
+
+    def watch(self):
+        """ wait for changes, returns when it's time to resync """
+        while True:
+            with self.lock:
+                self.client.idletimeout = self.model.time_to_resync()  # None: block until something changes
+            try:
+                changed = self.client.idle(*self.subsystems)
+            except SocketTimeout:
+                # nothing changed, but the extrapolated elapsed time must be compared with mpd's again. An interrupted
+                # idle leaves the connection unusable, so the resync is done by reconnecting.
+                self.logger.debug("mpd: resync")
+                return
+            self.logger.debug("mpd: idle returned " + str(changed))
+            if self.status_subsystems.intersection(changed):
+                self.refresh()
+            if 'stored_playlist' in changed:
+                events.post(events.MPD_IDLE, changed=changed, playlists=self.client.listplaylists())
+            else:
+                events.post(events.MPD_IDLE, changed=changed)
+
+    def refresh(self):
+        status = self.client.status()
+        status.update(self.client.currentsong())
+        with self.lock:
+            self.snapshot = status
+            self.model.update(status)
+        self.ready.set()
+
+    def disconnect(self):
+        try:
+            self.client.disconnect()
+        except (mpd.ConnectionError, SocketError):
+            pass
+
+
+idempotent = {'setvol', 'play', 'pause', 'stop', 'clear'}  # (pause only with an argument, see Command.is_idempotent)
+
+
+class Command:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.count = 1
+
+    def calls(self):
+        """ :return: list of tuples (command name, arg1, arg2, ...) to send to mpd """
+        return [(self.name,) + tuple(self.args)] * self.count
+
+    def is_idempotent(self):
+        """ :return: True if executing this command twice has the same result as executing it once """
+        for call in self.calls():
+            if call[0] == 'clear':
+                return True  # whatever follows starts from scratch
+            if call[0] not in idempotent:
+                return False
+            if call[0] == 'pause' and len(call) < 2:
+                return False  # without an argument, pause toggles
+        return True
+
+    def __str__(self):
+        return self.name + str(self.args) + ('' if self.count == 1 else ' x' + str(self.count))
+
+
+class Batch(Command):
+    def __init__(self, commands):
+        Command.__init__(self, 'command_list', tuple(commands))
+
+    def calls(self):
+        return list(self.args)
+
+
+ack_pattern = re.compile(r'\[\d+@(\d+)\]')  # ACK [error@command_listNum] {current_command} message_text
+
+
+def execute_batch(client, commands):
+    """
+    send commands in a single command list, i.e. a single round trip
+    :param client: connected MPDClient
+    :param commands: list of tuples (command name, arg1, arg2, ...)
+    :return: list with the result of every command
+    """
+    client.command_list_ok_begin()
+    for command in commands:
+        getattr(client, command[0])(*command[1:])
+    try:
+        return client.command_list_end()
+    except mpd.CommandError as e:
+        match = ack_pattern.search(str(e))
+        position = int(match.group(1)) if match else 0
+        raise BatchError(position, commands[position], e)
+
+
+class CommandWorker(Thread):
+    """
+    Executes mpd commands for the UI on a dedicated connection, so a slow (or restarting) mpd doesn't block the event
+    loop. Commands are queued with submit(), for every executed command a MPD_COMMAND event is posted.
+    Redundant commands that are still waiting in the queue are coalesced.
+    While mpd is unreachable, idempotent commands are kept and replayed once the link is back, other commands fail.
+    """
+    accumulate = {'next', 'previous'}  # repeated commands add up and are executed in one go
+    replace = {'setvol'}  # only the last value matters
+
+    def __init__(self, host, port, health):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.host = host
+        self.port = port
+
+        self.client = mpd.MPDClient()
+        self.client.timeout = 10
+        self.connected = False
+
+        self.condition = Condition()
+        self.pending = []
+
+        self.health = health  # CircuitBreaker
+        health.add_listener(self.health_changed)
+
+    def submit_batch(self, commands):
+        self.__submit(Batch(commands))
+
+    def submit(self, name, *args):
+        self.__submit(Command(name, args))
+
+    def __submit(self, command):
+        if not self.health.is_connected() and not command.is_idempotent():
+            self.report(command, error=mpd.ConnectionError('mpd unreachable'))
+            return
+        with self.condition:
+            last = self.pending[-1] if self.pending else None
+            if last and last.name == command.name and command.name in self.accumulate:
+                last.count += 1
+            elif last and last.name == command.name and command.name in self.replace:
+                last.args = command.args
+            else:
+                self.pending.append(command)
+            self.logger.debug("submit " + str(command) + ", queue: " + ', '.join(str(c) for c in self.pending))
+            self.condition.notify()
+
+    def health_changed(self):
+        with self.condition:
+            if not self.health.is_connected():
+                rejected = [c for c in self.pending if not c.is_idempotent()]
+                self.pending = [c for c in self.pending if c.is_idempotent()]
+                for command in rejected:
+                    self.report(command, error=mpd.ConnectionError('mpd unreachable'))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending or not (self.connected or self.health.allow()):
+                    self.condition.wait(self.health.wait_time() if self.pending else None)
+                command = self.pending.pop(0)
+            self.execute(command)
+
+    def execute(self, command):
+        result, error = None, None
+        try:
+            result = self.call(command.calls())
+        except (mpd.CommandError, BatchError) as e:
+            self.logger.warning('mpd: ' + str(command) + ' failed: ' + str(e))
+            error = e
+        except (mpd.MPDError, SocketError) as e:
+            # connection lost, or left in an unknown state: start over with a new one
+            self.logger.info('mpd: ' + e.__class__.__name__ + ' (' + str(e) + ') while executing ' + str(command))
+            self.disconnect()
+            if command.is_idempotent():
+                self.logger.info('mpd: ' + str(command) + ' will be replayed')
+                with self.condition:
+                    self.pending.insert(0, command)
+                self.health.failed()
+                return
+            self.health.failed()
+            error = e
+        except Exception as e:
+            # a bug (e.g. an unknown command name), not mpd's fault: keep the worker alive, the connection may be left
+            # halfway a command list
+            self.logger.exception('mpd: error while executing ' + str(command) + ': ' + str(e))
+            self.disconnect()
+            error = e
+        self.report(command, result, error)
+
+    def call(self, calls):
+        """
+        A connection that has been open for a while may have been closed by mpd in the meantime (after its
+        connection_timeout), that only shows when it's used: then the calls are retried once, on a new connection.
+        :return: the result of the calls
+        """
+        reused = self.connected
+        self.connect()
+        try:
+            return self.__call(calls)
+        except (mpd.ConnectionError, SocketError) as e:
+            if not reused:
+                raise
+            self.logger.info('mpd: ' + e.__class__.__name__ + ' (' + str(e) + ') on an old connection, reconnecting...')
+            self.disconnect()
+            self.connect()
+            return self.__call(calls)
+
+    def __call(self, calls):
+        if len(calls) == 1:
+            return getattr(self.client, calls[0][0])(*calls[0][1:])
+        return execute_batch(self.client, calls)
+
+    @staticmethod
+    def report(command, result=None, error=None):
+        events.post(events.MPD_COMMAND, command=command.name, args=command.args, count=command.count,
+                    result=result, error=error)
+
+    def connect(self):
+        if not self.connected:
+            self.client.connect(self.host, self.port)
+            self.connected = True
+            self.health.succeeded()
+
+    def disconnect(self):
+        self.connected = False
+        try:
+            self.client.disconnect()
+        except (mpd.ConnectionError, SocketError):
+            pass
+
+
 class PiMPD(MyMPD):
     connected = False
+    watcher = None
 
-    def __init__(self, screen_size):
-        MyMPD.__init__(self, screen_size)
+    host = 'localhost'
+    port = 6600
 
-        global paths
-        mpd_path = "/var/lib/mpd/"
-        paths['music_path'] = mpd_path + "music/"
-        paths['playlists_path'] = mpd_path + "playlists/"
+    def __init__(self, screen_size, thumb_size=None, workers=None, processes=False):
+        MyMPD.__init__(self, screen_size, thumb_size, workers, processes)
+
+        init_local_paths()
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.client = mpd.MPDClient()
         self.client.timeout = 10
 
+        # all connections to mpd share their view on its health
+        self.health = CircuitBreaker()
+
+        # commands from the UI are executed in the background, on their own connection
+        self.commands = CommandWorker(self.host, self.port, self.health)
+        self.commands.start()
+
     def connect(self):
+        """ blocks until connected, so only to be used where waiting is acceptable (i.e. at startup) """
         while not self.connected:
+            self.health.wait_until_allowed()
             try:
-                self.client.connect('localhost', 6600)
+                self.client.connect(self.host, self.port)
                 self.connected = True
+                self.health.succeeded()
             except SocketError as e:
-                self.logger.error(str(e))
-
-            if not self.connected:
-                self.logger.debug("mpd: Couldn't connect. Retrying...")
-                sleep(5)
+                self.logger.error("mpd: Couldn't connect (" + str(e) + ")")
+                self.health.failed()
 
         self.logger.debug("mpd: connected, status=" + self.client.status()['state'])
 
     def __client_call(self, call, *args):
         try:
             self.connect()
-            if args:
-                return call(*args)
-            else:
-                return call()
+            return call(*args)
         except mpd.ConnectionError as e:
             self.connected = False
             self.logger.info('mpd: ConnectionError (' + str(e) + '), reconnecting...')
             self.connect()
-            return self.__client_call(call, *args)
-
-    def init_playlists(self):
-        playlists = []
-        source = self.__client_call(self.client.listplaylists)
-        source.sort(key=lambda current: current['playlist'])
+            return call(*args)  # retry only once, a second failure is passed on
 
-        for pl in source:
-            playlist = Playlist(pl, self.loader, self.default_cover)
-            playlists.append(playlist)
-            self.logger.debug("loaded playlist " + str(playlist.playlist))
+    def subscribe(self):
+        if not self.watcher:
+            self.watcher = StatusWatcher(self.host, self.port, self.health)
+            self.watcher.start()
 
-        self.logger.info("%d playlists loaded", len(playlists))
+    def is_connected(self):
+        return self.health.is_connected()
 
-        return playlists
+    def init_playlists(self):
+        return self.create_playlists(self.__client_call(self.client.listplaylists))
 
     def clear(self):
-        self.__client_call(self.client.clear)
+        self.commands.submit('clear')
 
     def previous(self):
-        self.__client_call(self.client.previous)
+        self.commands.submit('previous')
 
     def next(self):
-        self.__client_call(self.client.next)
+        self.commands.submit('next')
 
     def play(self):
-        self.__client_call(self.client.play)
+        self.commands.submit('play')
 
     def pause(self):
-        self.__client_call(self.client.pause)
+        self.commands.submit('pause', 1)  # not just 'pause', that toggles
 
     def stop(self):
-        self.__client_call(self.client.stop)
+        self.commands.submit('stop')
 
     def setvol(self, v):
-        self.__client_call(self.client.setvol, v)
+        self.commands.submit('setvol', v)
 
     def load(self, playlist):
-        self.__client_call(self.client.load, playlist)
+        self.commands.submit('load', playlist)
+
+    def batch(self, commands):
+        self.commands.submit_batch(commands)
 
     def currentsong(self):
         return self.__client_call(self.client.currentsong)
 
     def status(self):
+        if self.watcher:
+            return self.watcher.status()  # no network traffic at all (empty until the first status has arrived)
         # client.status()
         # {'songid': '1', 'playlistlength': '15', 'playlist': '18', 'repeat': '0', 'consume': '0', 'mixrampdb': '0.000000', 'random': '0', 'state': 'play', 'xfade': '0', 'volume': '55', 'single': '0', 'mixrampdelay': 'nan', 'nextsong': '1', 'time': '70:172', 'song': '0', 'elapsed': '69.590', 'bitrate': '1155', 'nextsongid': '2', 'audio': '44100:16:2'}
         # client.currentsong()
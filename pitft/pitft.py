@@ -5,6 +5,8 @@ import pygame
 import colors
 import logging
 import mympd
+import aiompd
+from scroll import calc_img_size
 
 
 def init_desktop():
@@ -50,17 +52,24 @@ def init_pitft():
 
 class PiTFT:
     platform = platform.system()
+    input_device = '/dev/input/touchscreen' if platform == "Linux" else None  # see SDL_MOUSEDEV in init_pitft
 
-    def __init__(self, stand_alone):
+    def __init__(self, stand_alone, backend='mpd', workers=None, processes=False):
+        """ :param workers, processes: how to load the covers, see image_tools.Loader """
         self.logger = logging.getLogger(self.__class__.__name__)
         self.stand_alone = stand_alone
 
         if self.platform == "Linux":
             self.screen = init_pitft()
-            self.mympd = mympd.PiMPD(self.screen.get_size())
+            size = self.screen.get_size()
+            if backend == 'asyncio':
+                self.mympd = aiompd.AsyncMPD(size, calc_img_size(size[0]), workers, processes)
+            else:
+                self.mympd = mympd.PiMPD(size, calc_img_size(size[0]), workers, processes)
         elif self.platform == "Windows":
             self.screen = init_desktop()
-            self.mympd = mympd.WinMPD(self.screen.get_size())
+            size = self.screen.get_size()
+            self.mympd = mympd.WinMPD(size, calc_img_size(size[0]), workers, processes)
         else:
             raise Exception("unknown platform: " + self.platform)
 
@@ -81,11 +90,10 @@ class PiTFT:
 
         self.clock = pygame.time.Clock()
 
+    animation_fps = 60  # frame rate while something is moving, there are no frames at all when nothing moves
+
     def clock_tick(self):
-        if self.platform == "Linux":
-            self.clock.tick(360)
-        elif self.platform == "Windows":
-            self.clock.tick(80)
+        self.clock.tick(self.animation_fps)
 
     def exit(self):
         self.logger.info("exit")
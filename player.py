@@ -1,4 +1,5 @@
 import os
+import math
 import logging
 
 import pygame
@@ -8,7 +9,12 @@ from button import Button, ToggleButton
 import colors
 from pitft.pitft import PiTFT
 from scene import Scene
-from image_tools import resize_to_fill
+from image_tools import render_background, Backgrounds
+from gesture import Gesture, GestureRecognizer
+from animation import animations
+from scheduler import jobs
+from mympd import StatusModel
+import events
 
 
 class Progress(pygame.sprite.DirtySprite):
@@ -55,16 +61,24 @@ class Progress(pygame.sprite.DirtySprite):
             self.blinking = blinking
             self._make_dirty()
 
+    blink_rate = 1.5  # changes per second
+
     def update(self):
         if self.blinking:
-            import time
-            t = int(time.time() * 1.5) % 2 == 0
+            t = int(time.time() * self.blink_rate) % 2 == 0
             vis = 1 if t else 0
             if self.visible != vis:
                 self.logger.debug("self.set_visible(" + str(vis) + ")")
                 self.visible = vis
                 self._make_dirty()
 
+    def next_change(self):
+        """ :return: seconds until the progress bar blinks again, None if it doesn't blink """
+        if not self.blinking:
+            return None
+        now = time.time() * self.blink_rate
+        return (math.floor(now) + 1 - now) / self.blink_rate
+
     def _make_dirty(self):
         if self.dirty != 2:
             self.dirty = 1
@@ -109,6 +123,7 @@ class InfoText(MySprite):
 
         self.text = ""
         self.image = self._create_surface()
+        self.render_job = None
 
         MySprite.__init__(self, Location.SOUTH, position, screen)
 
@@ -118,10 +133,16 @@ class InfoText(MySprite):
         if self.text != text:
             self.logger.debug(str(self) + '.set_text(' + text + ')')
             self.text = text
-            self.image = self._create_surface()
+            jobs.cancel(self.render_job)  # the text that was still waiting to be rendered is outdated
+            self.render_job = jobs.submit(self._create_surface, 'text', priority=10, on_done=self.set_image)
             return True
         return False
 
+    def set_image(self, image):
+        self.image = image
+        self.render_job = None
+        self._make_dirty()
+
     def _create_surface(self):
         surface = pygame.Surface((self.rect.width, self.rect.height)).convert_alpha()
         surface.fill(pygame.Color(0,0,0,0)) # fully transparent
@@ -133,8 +154,10 @@ class InfoText(MySprite):
 class Player(Scene):
 
     playlist = None
-    cover_img = None
     dirty = True
+    pending_volume = None  # volume that has been set, but may not be reported by mpd yet
+    inactivity_time = 20  # seconds without input before the buttons disappear
+    status = {}  # as used in the last draw()
 
     sprites = pygame.sprite.LayeredDirty()
 
@@ -159,8 +182,8 @@ class Player(Scene):
         self.stop_btn = self.create_button('stop', self.stop)
         self.list_btn = self.create_button('list', (lambda: self.go_to(browser)), Location.NORTH)
         self.exit_btn = self.create_button('exit', self.exit, Location.NORTH)
-        self.vol_down_btn = self.create_button('vol_down', (lambda: self.set_vol(int(self.mympd.status()['volume']) - 5)))
-        self.vol_up_btn = self.create_button('vol_up', (lambda: self.set_vol(int(self.mympd.status()['volume']) + 5)))
+        self.vol_down_btn = self.create_button('vol_down', (lambda: self.set_vol(self.get_vol() - 5)))
+        self.vol_up_btn = self.create_button('vol_up', (lambda: self.set_vol(self.get_vol() + 5)))
 
         # self.proceed = self.create_button('proceed', (lambda: 1))
         self.progress = Progress()
@@ -169,7 +192,8 @@ class Player(Scene):
         self.info_text = InfoText(self.screen_size[0], (0,self.screen_size[1]-20), browser.view_port)
         self.sprites.add(self.info_text)
 
-        self.background = pygame.display.get_surface().convert()
+        self.background = pygame.display.get_surface().convert()  # the cover of the playlist, filling the screen
+        self.backgrounds = Backgrounds(self.screen_size, self.mympd.mailbox)
 
         # buttons at bottom of screen, from left to right
         y = self.screen_size[1] - 45 - self.x_offset(0, 7)
@@ -187,7 +211,9 @@ class Player(Scene):
         x = self.x_offset(i, len(btns))
         self.list_btn.set_position((x,y))
 
-        self.time = time.clock()
+        self.gestures = GestureRecognizer('Player')
+
+        self.time = time.monotonic()
 
     def create_button(self, name, callback, location=Location.SOUTH):
         btn = Button(name, callback, location)
@@ -206,18 +232,34 @@ class Player(Scene):
 
     def start_playlist(self, playlist):
         self.logger.info("start playing " + str(playlist))
+        if self.playlist:
+            self.playlist.unpin()
+        playlist.pin()  # the cover of the playing playlist stays in memory
         self.playlist = playlist
-        self.cover_img = resize_to_fill(playlist.cover_img, self.screen_size)
+        background = self.backgrounds.get(playlist.image_key, playlist.cover_img,
+                                          callback=lambda background: self.set_background(playlist, background))
+        if background is None:
+            # not prefetched: a quick preview until the real one is ready
+            background = render_background(playlist.cover_img, self.screen_size, smooth=False)
+        self.background = background
 
         self.dirty = True
 
-        self.stop()
-        self.mympd.clear()
-        self.mympd.load(self.playlist.playlist)
-        self.play()
+        self.mympd.batch([('stop',), ('clear',), ('load', self.playlist.playlist), ('play',)])
+        self.play_btn.set_action('pause')
+        self.progress.set_blinking(False)
 
         return self
 
+    def set_background(self, playlist, background):
+        if playlist is self.playlist:
+            self.background = background
+            self.dirty = True
+
+    def prefetch(self, playlists):
+        """ get the backgrounds of playlists ready (e.g. the ones that are visible in the browser) """
+        self.backgrounds.prefetch([(playlist.image_key, playlist.cover_img) for playlist in playlists])
+
     def play(self):
         self.mympd.play()
         self.play_btn.set_action('pause')
@@ -228,10 +270,17 @@ class Player(Scene):
         self.play_btn.set_action('play')
         self.progress.set_blinking(True)
 
+    def get_vol(self):
+        volume = int(self.mympd.status().get('volume', 0))
+        if self.pending_volume == volume:
+            self.pending_volume = None
+        return volume if self.pending_volume is None else self.pending_volume
+
     def set_vol(self, vol):
         minmax = (0,100)
         real_vol = min(max(vol, minmax[0]), minmax[1])
 
+        self.pending_volume = real_vol
         self.mympd.setvol(real_vol)
 
         self.vol_down_btn.set_visible(real_vol != minmax[0])
@@ -246,9 +295,20 @@ class Player(Scene):
         self.mytft.exit()
 
     def handle(self, event):
-        self.time = time.clock()
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            clicked_buttons = [b for b in self.sprites if b.rect.collidepoint(event.pos)]
+        self.time = time.monotonic()
+        if event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEMOTION, pygame.MOUSEBUTTONUP):
+            for gesture in self.gestures.feed(event):
+                self.gesture(gesture)
+        elif event.type == events.MPD_CONNECTION:
+            self.time = time.monotonic()  # show (or stop showing) that we're disconnected
+        elif event.type == events.MPD_COMMAND and event.error:
+            self.logger.debug("mpd command '" + event.command + "' failed: " + str(event.error))
+            if event.command == 'setvol':
+                self.pending_volume = None
+
+    def gesture(self, gesture):
+        if gesture.kind == Gesture.TAP:
+            clicked_buttons = [b for b in self.sprites if b.rect.collidepoint(gesture.pos)]
             if clicked_buttons:
                 button = clicked_buttons[-1] # if multiple buttons on top of each other: topmost button only
                 if hasattr(button, 'execute'):
@@ -256,15 +316,20 @@ class Player(Scene):
                     button.execute()
 
     def clear(self, screen):
-        self.sprites.clear(screen, self.cover_img[0])
+        self.sprites.clear(screen, self.background)
 
     def draw(self, surface):
-        status = self.mympd.status()
+        for gesture in self.gestures.tick():
+            self.time = time.monotonic()
+            self.gesture(gesture)
+
+        status = self.status = self.mympd.status()
 
         # proceed button
+        duration = self.duration(status)
         try:
-            progress = float(status['elapsed']) / int(self.mympd.currentsong()['time'])
-        except KeyError:  # can't find key 'elapsed' or 'time'
+            progress = float(status['elapsed']) / duration if duration else 0
+        except (KeyError, ValueError):  # no (usable) 'elapsed'
             progress = 0
 
         self.progress.set_progress(progress)
@@ -278,12 +343,13 @@ class Player(Scene):
             text = str(status['track']) + " - " + text
         elif 'song' in status:
             text = str(int(status['song']) + 1) + " - " + text
+        if not self.mympd.is_connected():
+            text = "disconnected - " + text
         if self.info_text.set_text(text):
-            self.time = time.clock() # dit zal zorgen dat buttons en names opnieuw getoond worden
+            self.time = time.monotonic() # dit zal zorgen dat buttons en names opnieuw getoond worden
 
         # album-art tekenen
         if self.dirty:
-            self.background.blit(self.cover_img[0], self.cover_img[1])
             surface.blit(self.background, (0,0))
             pygame.display.flip()
             for s in self.sprites:
@@ -292,7 +358,7 @@ class Player(Scene):
 
         # disappear?
         if self.time:
-            if time.clock() - self.time > 20: # seconds inactivity
+            if time.monotonic() - self.time > self.inactivity_time:
                 for sprite in self.sprites:
                     if hasattr(sprite, 'disappear'):
                         sprite.disappear()
@@ -303,12 +369,39 @@ class Player(Scene):
                         sprite.reappear()
 
         # sprites tekenen
-        self.sprites.update()
+        animations.update()  # only the sprites that are moving
+        self.progress.update()
         result = self.sprites.draw(surface)
         self.dirty = False
 
         return result
 
+    def next_frame(self):
+        if self.dirty or animations.is_animating():
+            return 0
+        now = time.monotonic()
+        delays = [self.progress.next_change()]
+        if self.time:
+            delays.append(self.time + self.inactivity_time - now)
+        deadline = self.gestures.next_deadline()
+        if deadline is not None:
+            delays.append(deadline - now)
+        duration = self.duration(self.status)
+        if self.status.get('state') == 'play' and duration:
+            # the progress bar moves a pixel every so often
+            pixels = max(1, self.progress.area.right - self.progress.rect.width)
+            delays.append(min(1.0, duration / pixels))
+        delays = [d for d in delays if d is not None]
+        return max(0.0, min(delays)) if delays else None
+
+    @staticmethod
+    def duration(status):
+        """ :return: length of the current song in seconds, None if unknown (e.g. for a radio stream) """
+        try:
+            return StatusModel.parse_duration(status) or None
+        except ValueError:
+            return None
+
     def x_offset(self, i, nb):
         return (30 * i) + ((float(self.screen_size[0]) - (nb * 30)) / (nb + 1)) * (i + 1)
 
@@ -339,7 +432,14 @@ if __name__ == '__main__':
     class MyPlaylist:
         def __init__(self):
             self.playlist = "test"
+            self.image_key = "test"
             self.cover_img = pygame.image.load(os.path.join('player_icons', 'Cover.png')).convert_alpha()
+
+        def pin(self):
+            pass
+
+        def unpin(self):
+            pass
     playlist = MyPlaylist()
 
     pygame.display.flip()
@@ -10,6 +10,13 @@ class Scene(object):
     def draw(self, surface):
         raise NotImplementedError
 
+    def next_frame(self):
+        """
+        :return: seconds until the scene needs to be drawn again, if nothing happens in the meantime: 0 if it's
+        animating, None if only an event can change it
+        """
+        return 0
+
     def clear(self, screen):
         raise NotImplementedError
 
@@ -0,0 +1,106 @@
+import heapq
+import itertools
+import logging
+from time import monotonic
+
+__author__ = 'jeroen'
+
+
+def single_step(function):
+    """ a job that does all of its work in one go: calls function, and returns what it returns """
+    return function()
+    yield  # makes this a generator
+
+
+class Task:
+    def __init__(self, name, steps, priority, on_done):
+        self.name = name
+        self.steps = steps  # generator: every next() does a bit of the work
+        self.priority = priority
+        self.on_done = on_done
+        self.cancelled = False
+
+    def __str__(self):
+        return 'Task(' + self.name + ', priority=' + str(self.priority) + ')'
+
+
+class Scheduler:
+    """
+    Runs expensive work on the pygame thread without making a frame miss its deadline. A job is a generator that
+    yields whenever it has done a bit of its work. Once per frame, run() takes the most urgent jobs one step at a time,
+    until the budget for the frame is used up. A single step that takes longer than the whole budget is reported.
+    """
+    default_priority = 100  # lower is more urgent
+    WAIT = 'wait'  # yielded by a job that can't go on before the next frame (e.g. until what it did is on the screen)
+
+    def __init__(self, budget=0.008):
+        """ :param budget: seconds per frame """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.budget = budget
+        self.heap = []  # entries (priority, sequence number, task)
+        self.counter = itertools.count()
+        self.overruns = 0
+        self.steps = 0
+
+    def submit(self, steps, name='job', priority=default_priority, on_done=None):
+        """
+        :param steps: generator, its return value is passed to on_done (or a function, for a job of a single step)
+        :param on_done: called (on the pygame thread) with the result when the job is done
+        :return: the Task, for cancel()
+        """
+        if callable(steps):
+            steps = single_step(steps)
+        task = Task(name, steps, priority, on_done)
+        heapq.heappush(self.heap, (priority, next(self.counter), task))
+        return task
+
+    def cancel(self, task):
+        if task:
+            task.cancelled = True
+            task.steps.close()
+
+    def __len__(self):
+        return len([entry for entry in self.heap if not entry[2].cancelled])
+
+    def run(self, budget=None):
+        """ do as much work as fits in budget (default: the scheduler's budget), but at least one step """
+        budget = self.budget if budget is None else budget
+        start = monotonic()
+        deadline = start + budget
+        waiting = []
+        while self.heap:
+            task = self.heap[0][2]
+            if task.cancelled:
+                heapq.heappop(self.heap)
+                continue
+            step_start = monotonic()
+            try:
+                if next(task.steps) is self.WAIT:
+                    waiting.append(heapq.heappop(self.heap))
+            except StopIteration as e:
+                heapq.heappop(self.heap)
+                if task.on_done:
+                    try:
+                        task.on_done(e.value)
+                    except Exception as e:
+                        self.logger.exception("error in on_done of " + str(task) + ": " + str(e))
+            except Exception as e:
+                heapq.heappop(self.heap)
+                self.logger.exception("error in " + str(task) + ": " + str(e))
+            now = monotonic()
+            self.steps += 1
+            if now - step_start > budget:
+                self.overruns += 1
+                self.logger.warning("%s: a single step took %.1f ms, the budget for a frame is %.1f ms (%d of %d "
+                                    "steps too long)", task, 1000 * (now - step_start), 1000 * budget, self.overruns,
+                                    self.steps)
+            if now >= deadline:
+                break
+        for entry in waiting:
+            heapq.heappush(self.heap, entry)
+        if self.heap:
+            self.logger.debug("%.1f ms of work done, %d jobs left for the next frame", 1000 * (monotonic() - start),
+                              len(self))
+
+
+jobs = Scheduler()  # for all scenes, run by main once per frame
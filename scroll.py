@@ -2,10 +2,15 @@ import math
 import pygame
 import colors
 import logging
-import threading
+import weakref
+from collections import deque
+from time import monotonic
 from scene import Scene
+from kinetic import KineticScroller
+from gesture import Gesture, GestureRecognizer
 from image_tools import resize_to_fit
 from button import Button
+from scheduler import jobs
 
 __author__ = 'jeroen'
 
@@ -17,9 +22,16 @@ filled = colors.red.correct_gamma(100)
 
 
 class ScrollPane(Scene):
+    """
+    The grid of playlists. The playlists are laid out in world coordinates and drawn, one row at a time, on a strip that
+    covers the view port plus some overscan. Scrolling moves a camera over the world: the view is a single blit from
+    the strip (on a canvas that the buttons use as background), only the rows that scroll into the strip get drawn.
+    """
     player = None
 
-    playlistButtons = []
+    cancel_rows = 20  # covers of playlists further away than this are only loaded when they come closer
+    overscan_rows = 1  # rows kept ready above and below the view port
+
     allSprites = pygame.sprite.LayeredDirty()
 
     def __init__(self,
@@ -32,9 +44,20 @@ class ScrollPane(Scene):
         self.view_port = init_rect
 
         self.thumb_size = calc_img_size(init_rect.size[0])
-        x, y = 0, 0
-        for playlist in playlists:
-            x, y = self.create_thumb(playlist, x, y)
+        self.row_height = int(math.ceil(self.thumb_size[1])) + spacing
+        self.playlists = playlists
+        self.scroller = KineticScroller(-self.max_scroll(), 0, snap=self.row_height)  # position: 0 or less
+        self.gestures = GestureRecognizer('ScrollPane')
+        self.stopped = False  # the last press stopped the grid from moving, it's not a tap on a playlist
+        self.on_button = False  # the last press was on a button: the grid keeps moving (taps on up/down add up)
+        self.requested = (0, len(playlists))  # range of playlists that may have their cover queued in the loader
+
+        self.strip_rows = int(math.ceil(init_rect.height / float(self.row_height))) + 1 + 2 * self.overscan_rows
+        self.strip = pygame.Surface((init_rect.width, self.strip_rows * self.row_height)).convert()
+        self.strip_row = 0  # first row on the strip
+        self.canvas = pygame.Surface(init_rect.size).convert()  # the view port, without the buttons
+        self.thumbs = {}  # playlist index --> PlaylistThumb, for the playlists on the strip
+        self.updated = deque()  # PlaylistThumbs with a new cover, to be drawn on the strip
 
         self.scrolling = False
         self.offset = [0, 0]
@@ -44,29 +67,113 @@ class ScrollPane(Scene):
         self.down = self.create_button('down', (lambda: self.scroll('down')), 320-30-10, 240-30-10)
         self.topleft = self.create_button('topleft', self.go_to_player, 5, 5)
 
-    def create_thumb(self, playlist, x, y):
-        base_pos = (border + x * (self.thumb_size[0] + spacing), border + y * (self.thumb_size[1] + spacing))
-        new_button = PlaylistButton(playlist, self.thumb_size, base_pos, self)
-        self.playlistButtons.append(new_button)
-        self.allSprites.add(new_button)
-
-        if x == (nb_cols - 1):
-            y += 1
-        x = (x + 1) % nb_cols
-
-        return x,y
+        self.render_strip()
+        self.update_priorities()
+
+    def cell_pos(self, i):
+        """ :return: topleft of the thumbnail area of the i-th playlist, on the strip """
+        x, y = i % nb_cols, i // nb_cols - self.strip_row
+        return border + x * (int(self.thumb_size[0]) + spacing), y * self.row_height + spacing
+
+    def strip_top(self):
+        """ :return: where the strip is in the view port """
+        return int(border - spacing + self.strip_row * self.row_height + self.scroller.position)
+
+    def max_scroll(self):
+        """ :return: how far the grid can be scrolled down, before the last row comes into view """
+        rows = int(math.ceil(len(self.playlists) / float(nb_cols)))
+        height = 2 * border + rows * self.row_height - spacing
+        return max(0, height - self.view_port.height)
+
+    def first_row(self):
+        """ :return: the first row that should be on the strip """
+        return max(0, int((-self.scroller.position - border) // self.row_height) - self.overscan_rows)
+
+    def layout(self):
+        """ move the strip along with the camera, drawing only the rows that scroll into it """
+        first_row = self.first_row()
+        shift = first_row - self.strip_row
+        if shift != 0 and self.scroller.state == KineticScroller.DRAGGING:
+            self.update_priorities()  # nobody knows where the finger is going: just follow it
+        if shift == 0:
+            pass
+        elif abs(shift) >= self.strip_rows:
+            self.strip_row = first_row
+            self.render_strip()
+            return
+        else:
+            self.strip.scroll(dy=-shift * self.row_height)
+            self.strip_row = first_row
+            self.forget_thumbs()
+            new_rows = range(self.strip_rows - shift, self.strip_rows) if shift > 0 else range(0, -shift)
+            for row in new_rows:
+                self.render_row(first_row + row)
+        self.compose()
+
+    def render_strip(self):
+        self.forget_thumbs()
+        for row in range(self.strip_rows):
+            self.render_row(self.strip_row + row)
+        self.compose()
+
+    def render_row(self, row):
+        self.strip.fill(colors.grey, pygame.Rect(0, (row - self.strip_row) * self.row_height,
+                                                 self.strip.get_width(), self.row_height))
+        for i in range(row * nb_cols, min(len(self.playlists), (row + 1) * nb_cols)):
+            thumb = self.thumbs.get(i)
+            if thumb and thumb.playlist is not self.playlists[i]:
+                thumb.release()
+                thumb = None
+            if not thumb:
+                thumb = self.thumbs[i] = PlaylistThumb(self.playlists[i], i, self.thumb_size, self.updated)
+            thumb.draw(self.strip, self.cell_pos(i))
+
+    def forget_thumbs(self):
+        """ stop listening to the playlists that are no longer on the strip """
+        first, last = self.strip_row * nb_cols, (self.strip_row + self.strip_rows) * nb_cols
+        for i in [i for i in self.thumbs if not first <= i < min(last, len(self.playlists))]:
+            self.thumbs.pop(i).release()
+
+    def compose(self):
+        """ draw the view port on the canvas, and make sure it gets on the screen """
+        self.canvas.blit(self.background, origin)
+        self.canvas.blit(self.strip, (0, self.strip_top()))
+        self.allSprites.repaint_rect(self.view_port)
+
+    def redraw_updated(self):
+        """ draw the covers that have been loaded since the last frame """
+        redrawn = False
+        while self.updated:
+            thumb = self.updated.popleft()
+            if self.thumbs.get(thumb.index) is thumb:
+                x, y = self.cell_pos(thumb.index)
+                self.strip.fill(colors.grey, pygame.Rect((x, y), self.thumb_size))
+                thumb.draw(self.strip, (x, y))
+                redrawn = True
+        if redrawn:
+            self.compose()
+            self.prefetch_backgrounds()  # the new covers
 
     def create_button(self, name, callback, x, y):
         btn = Button(name, callback, None, (x,y))
         self.allSprites.add(btn)
         return btn
 
+    def set_playlists(self, playlists):
+        """ show a new list of playlists (see MyMPD.update_playlists) """
+        self.playlists = playlists
+        self.requested = (0, len(playlists))  # new playlists queue their cover as soon as they're created
+        self.scroller.set_bounds(-self.max_scroll(), 0)
+        self.strip_row = self.first_row()
+        self.render_strip()
+        self.update_priorities()
+
     def clear(self, screen):
-        screen.blit(self.background, (0,0))
+        screen.blit(self.canvas, (0,0))
         pygame.display.flip()
         for f in self.allSprites:
             f.dirty = 1
-        self.allSprites.clear(screen, self.background)
+        self.allSprites.clear(screen, self.canvas)
 
     def go_to_player(self):
         self.manager.go_to(self.player)
@@ -77,40 +184,115 @@ class ScrollPane(Scene):
     def handle(self, event):
         # if __debug__:
         #     print "Player: handle(" + str(event) + ")"
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            clicked_buttons = [b for b in self.allSprites if b.rect.collidepoint(event.pos)]
-            if clicked_buttons:
-                button = clicked_buttons[-1] # if multiple buttons on top of each other: topmost button only
+        for gesture in self.gestures.feed(event):
+            self.gesture(gesture)
+
+    def gesture(self, gesture):
+        if gesture.kind == Gesture.PRESS:
+            self.on_button = self.button_at(gesture.pos) is not None
+            if not self.on_button:
+                self.stopped = self.scroller.is_moving()
+                self.scroller.press()
+        elif gesture.kind == Gesture.DRAG:
+            if not self.on_button:
+                self.scroller.drag(gesture.rel[1])
+        elif gesture.kind in (Gesture.RELEASE, Gesture.FLING):
+            if not self.on_button:
+                self.scroller.release(gesture.velocity[1], monotonic())
+                self.update_priorities()
+        elif gesture.kind == Gesture.TAP:
+            button = self.button_at(gesture.pos)
+            if button:
                 self.logger.debug("clicked on " + str(button) + " button")
                 button.execute()
+                return
+            playlist = self.playlist_at(gesture.pos) if not self.stopped else None
+            if playlist:
+                self.logger.debug("clicked on " + str(playlist.playlist))
+                self.start_playlist(playlist)
+
+    def button_at(self, pos):
+        """ :return: the visible button at pos, None if there's none """
+        clicked_buttons = [b for b in self.allSprites if b.visible and b.rect.collidepoint(pos)]
+        return clicked_buttons[-1] if clicked_buttons else None  # buttons on top of each other: topmost button only
+
+    def playlist_at(self, pos):
+        """ :return: the playlist shown at pos in the view port, None if there's none """
+        x, y = pos[0] - border, pos[1] - border - self.scroller.position  # relative to the first thumbnail, in the world
+        col, row = int(x // (int(self.thumb_size[0]) + spacing)), int(y // self.row_height)
+        i = row * nb_cols + col
+        if x < 0 or y < 0 or col >= nb_cols or i >= len(self.playlists):
+            return None
+        if x - col * (int(self.thumb_size[0]) + spacing) >= self.thumb_size[0]\
+                or y - row * self.row_height >= self.thumb_size[1]:
+            return None  # in between the thumbnails
+        return self.playlists[i]
 
     def scroll(self, updown):
         """
         :param updown: 'up' or 'down'
         :return:
         """
-        if self.playlistButtons[1].move != 0:
-            # we are already scrolling, ignore any other request
-            self.logger.debug("-- already scrolling, ignore")
-            return
-
         switcher = { 'up': +1,  'down': -1 }
-        offset = switcher.get(updown) * 2 * (self.thumb_size[1] + spacing)
+        offset = switcher.get(updown) * 2 * self.row_height
         self.logger.debug("scroll offset " + str(offset))
-        for pb in self.playlistButtons:
-            pb.do_move(offset)
+        self.scroller.scroll_to(self.scroller.target + offset, monotonic())  # adds up when already scrolling
+        self.update_priorities()
+
+    def visible_rows(self):
+        """ :return: tuple (first, last) of the rows in the view port, once scrolling is done """
+        offset = self.scroller.target
+        first_visible = max(0, int((-offset - border - self.thumb_size[1]) // self.row_height) + 1)
+        last_visible = int((self.view_port.height - offset - border) // self.row_height)
+        return first_visible, last_visible
+
+    def update_priorities(self):
+        """ load the covers of the visible playlists first, then the ones closest to the view port """
+        first_visible, last_visible = self.visible_rows()
+
+        lo = max(0, (first_visible - self.cancel_rows) * nb_cols)
+        hi = min(len(self.playlists), (last_visible + self.cancel_rows + 1) * nb_cols)
+        for i in range(*self.requested):
+            if not lo <= i < hi and i < len(self.playlists):
+                self.playlists[i].cancel_cover()
+        for i in range(lo, hi):
+            row = i // nb_cols
+            distance = first_visible - row if row < first_visible else max(0, row - last_visible)
+            self.playlists[i].request_cover(priority=distance)  # rows in view first, then the nearest ones
+        self.requested = (lo, hi)
+        if self.playlists:
+            self.logger.debug("cover loader queue depth: " + str(self.playlists[0].loader.depth()))
+        self.prefetch_backgrounds()
+
+    def prefetch_backgrounds(self):
+        """ let the player get the backgrounds of the visible playlists ready, so they open right away """
+        if self.player:
+            first_visible, last_visible = self.visible_rows()
+            self.player.prefetch(self.playlists[first_visible * nb_cols:(last_visible + 1) * nb_cols])
 
     def draw(self, surface):
         """
         :param surface: the surface to blit on
         :return: list of updates
         """
-        self.up.set_visible(self.playlistButtons[1].rect.topleft[1] <= 0)
-        self.down.set_visible(self.playlistButtons[-1].rect.bottomleft[1] >= self.background.get_size()[1])
+        for gesture in self.gestures.tick():
+            self.gesture(gesture)
+        if self.scroller.update(monotonic()):
+            self.layout()
+        self.redraw_updated()
+
+        self.up.set_visible(self.scroller.position < 0)
+        self.down.set_visible(self.scroller.position > -self.max_scroll())
 
         self.allSprites.update()
         return self.allSprites.draw(surface)
 
+    def next_frame(self):
+        if self.scroller.state == KineticScroller.MOVING or self.updated:
+            return 0
+        deadline = self.gestures.next_deadline()
+        return max(0.0, deadline - monotonic()) if deadline is not None else None
+
 
 nb_cols = 3
 border = 13
@@ -133,61 +315,67 @@ def calc_img_size(screen_width):
     return img_width, img_width
 
 
-class PlaylistButton(pygame.sprite.DirtySprite):
-    def __init__(self, playlist, thumb_size, base_pos, scroll_pane):
-        pygame.sprite.DirtySprite.__init__(self)
-
-        self.lock = threading.Lock()
-        self.lock.acquire()
-
-        try:
-            self.playlist = playlist
-            self.thumb_size = thumb_size
-
-            self.playlist.add_listener(self)
-
-            self.image, relpos = resize_to_fit(playlist.cover_img, thumb_size)
-            self.scroll_pane = scroll_pane
-            self.rect = self.image.get_rect()
-            self.rect.topleft = base_pos[0] + relpos[0], base_pos[1] + relpos[1]
+class PlaylistThumb:
+    """ the thumbnail of a playlist on the strip of the ScrollPane, redrawn when the cover has been loaded """
+    scaled = weakref.WeakKeyDictionary()  # cover --> tuple (image, position), for covers without a thumbnail
+    scaling = {}  # cover --> list of PlaylistThumbs waiting for it to be scaled
 
-            self.move = 0
-        finally:
-            self.lock.release()
+    def __init__(self, playlist, index, thumb_size, updated):
+        """
+        :param index: position of the playlist in the grid
+        :param updated: deque the thumbnail adds itself to when the cover changes
+        """
+        self.playlist = playlist
+        self.index = index
+        self.thumb_size = thumb_size
+        self.updated = updated
+        self.playlist.add_listener(self)
+        self.playlist.pin()  # on the strip: keep the cover in memory
 
     def playlist_updated(self):
-        self.lock.acquire()
-        try:
-            old_size = self.image.get_size()
-            old_topleft = self.rect.topleft
-            self.image, _ = resize_to_fit(self.playlist.cover_img, self.thumb_size)
-
-            final_size = self.image.get_size()
-            self.rect = self.image.get_rect()
-            self.rect.topleft = old_topleft[0] + (old_size[0] - final_size[0]) / 2,\
-                                old_topleft[1] + (old_size[1] - final_size[1]) / 2
-
-            self.dirty = 1
-        finally:
-            self.lock.release()
-
-    def update(self):
-        if self.move > 0:
-            offset = min(self.move, 10)
-        elif self.move < 0:
-            offset = max(self.move,-10)
-        else:
-            offset = 0
-        if offset != 0:
-            self.rect = self.rect.move((0, offset))
-            self.move -= offset
-            self.dirty = 1
+        self.updated.append(self)  # drawn with the others in the next frame
 
-    def do_move(self, offset):
-        self.move = offset
+    def release(self):
+        self.playlist.remove_listener(self)
+        self.playlist.unpin()
 
-    def execute(self):
-        self.scroll_pane.start_playlist(self.playlist)
+    def thumbnail(self):
+        """
+        :return: tuple (image, position relative to the topleft of the thumbnail area), None if the cover still has
+        to be scaled
+        """
+        image = self.playlist.thumb_img  # already scaled by the loader
+        if not image:
+            return self.scaled_cover()
+        size = image.get_size()
+        return image, ((self.thumb_size[0] - size[0]) / 2, (self.thumb_size[1] - size[1]) / 2)
+
+    def scaled_cover(self):
+        """ scale the cover in a job: once for all playlists that share it (e.g. the default cover) """
+        cover = self.playlist.cover_img
+        if cover in self.scaled:
+            return self.scaled[cover]
+        if cover not in self.scaling:
+            self.scaling[cover] = []
+            size = self.thumb_size
+            jobs.submit(lambda: resize_to_fit(cover, size), 'thumbnail',
+                        on_done=lambda thumbnail: PlaylistThumb.cover_scaled(cover, thumbnail))
+        if self not in self.scaling[cover]:
+            self.scaling[cover].append(self)
+        return None
+
+    @classmethod
+    def cover_scaled(cls, cover, thumbnail):
+        cls.scaled[cover] = thumbnail
+        for thumb in cls.scaling.pop(cover):
+            thumb.playlist_updated()
+
+    def draw(self, surface, pos):
+        """ :param pos: topleft of the thumbnail area on surface """
+        thumbnail = self.thumbnail()
+        if thumbnail:
+            image, relpos = thumbnail
+            surface.blit(image, (pos[0] + relpos[0], pos[1] + relpos[1]))
 
     def __str__(self):
-        return 'PlaylistButton ' + str(self.playlist)
+        return 'PlaylistThumb ' + str(self.playlist)
@@ -1,6 +1,7 @@
 from pygame.sprite import DirtySprite
 import logging
 from enum import Enum, unique
+from animation import animations, ease_in, ease_out
 
 
 @unique
@@ -18,7 +19,7 @@ class Location(Enum):
 
 
 class DisappearAppearSprite(DirtySprite):
-    move_offset = 1
+    move_time = 0.4  # seconds to disappear or reappear, whatever the frame rate
 
     def __init__(self,
                  location,  # Location enum, defines where the sprite must disappear to
@@ -35,28 +36,27 @@ class DisappearAppearSprite(DirtySprite):
 
         self.set_position(position)
 
-    def update(self):
-        diff_x = self.target_position[0] - self.rect.x
-        if diff_x > 0:
-            self.rect.x = min(self.rect.x + self.move_offset, self.target_position[0])
-        elif diff_x < 0:
-            self.rect.x = max(self.rect.x - self.move_offset, self.target_position[0])
+    def is_moving(self):
+        return animations.is_animating(self)
 
-        diff_y = self.target_position[1] - self.rect.y
-        if diff_y > 0:
-            self.rect.y = min(self.rect.y + self.move_offset, self.target_position[1])
-        elif diff_y < 0:
-            self.rect.y = max(self.rect.y - self.move_offset, self.target_position[1])
-
-        if diff_x != 0 or diff_y != 0:
-            self._make_dirty()
+    def move_to(self, position, easing=ease_out, on_done=None):
+        """ move smoothly to position (unless we're already there or on our way, on_done is called in any case) """
+        position = tuple(position)
+        if position == tuple(self.target_position) and (self.is_moving() or position == tuple(self.rect.topleft)):
+            if on_done:
+                animations.then(self, on_done)
+            return
+        self.target_position = position
+        animations.move(self, position, self.move_time, easing, on_done)
 
     def set_position(self, position, smooth=False):
         self.logger.debug(str(self) + '.set_position(' + str(position) + ')')
         self.base_position = position
         if smooth:
-            self.target_position = position
+            self.move_to(position)
         else:
+            animations.stop(self)
+            self.target_position = position
             self.rect.topleft = position
         self._make_dirty()
         return self.rect.copy()
@@ -65,8 +65,8 @@ class DisappearAppearSprite(DirtySprite):
         if self.dirty < 2:
             self.dirty = 1
 
-    def disappear(self):
-        self.target_position = self.location.strategy(self, self.screen)
+    def disappear(self, on_done=None):
+        self.move_to(self.location.strategy(self, self.screen), ease_in, on_done)
 
-    def reappear(self):
-        self.target_position = self.base_position
\ No newline at end of file
+    def reappear(self, on_done=None):
+        self.move_to(self.base_position, ease_out, on_done)
\ No newline at end of file